@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+
+from features.History import save_npy
+
+# Interaction matrices shared with the workers of ItemSimilarity.fit
+_worker_matrices = dict()
+
+
+def _init_worker(X, X_csc, norms):
+    _worker_matrices['X'] = X
+    _worker_matrices['X_csc'] = X_csc
+    _worker_matrices['norms'] = norms
+
+
+def _block_top_k(args):
+    """ Top-k neighbours of a block of items (used for multiprocessing)
+    """
+    start, end, k = args
+    return block_top_k(_worker_matrices['X'], _worker_matrices['X_csc'],
+                       _worker_matrices['norms'], start, end, k)
+
+
+def block_top_k(X, X_csc, norms, start, end, k):
+    """ Top-k cosine neighbours of the items start:end
+
+    Only the (end - start) x n_items block of the co-listen matrix is built.
+
+    Parameters
+    ----------
+    X: scipy csr_matrix, binary users x items matrix
+    X_csc: X as a csc_matrix
+    norms: Square root of the number of users of each item
+    start, end: Range of items of the block
+    k: Number of neighbours
+
+    Output
+    ------
+    neighbors: (end - start, k) array of item indices, -1 if missing
+    similarities: (end - start, k) float32 array, 0 if missing
+    """
+    co_listens = (X_csc[:, start:end].T @ X).tocsr()
+    co_listens.setdiag(0, k=start)
+    co_listens.eliminate_zeros()
+
+    rows = np.repeat(np.arange(end - start), np.diff(co_listens.indptr))
+    cols = co_listens.indices
+    sims = co_listens.data / (norms[start + rows] * norms[cols])
+
+    # Sort each row by decreasing similarity and keep the k first
+    order = np.lexsort((cols, -sims, rows))
+    rows, cols, sims = rows[order], cols[order], sims[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+
+    neighbors = np.full((end - start, k), -1, dtype=np.int32)
+    similarities = np.zeros((end - start, k), dtype=np.float32)
+    neighbors[rows[keep], rank[keep]] = cols[keep]
+    similarities[rows[keep], rank[keep]] = sims[keep]
+    return neighbors, similarities
+
+
+class ItemSimilarity():
+    """ Item-item cosine similarity computed from the co-listens of the users
+
+    Two tracks are similar when they are listened by the same users. Only the
+    k nearest neighbours of each track are kept, as compact arrays.
+    """
+
+    def __init__(self, k=20, block_size=2000, cores=1, path=None):
+        """
+        Parameters
+        ----------
+        k: Number of neighbours kept per track
+        block_size: Number of tracks per block of the co-listen matrix,
+                    bounds the memory used by fit
+        cores: Number of processes computing the blocks
+        path: Directory written by dump, to load an already fitted instance
+        """
+        self.k = k
+        self.block_size = block_size
+        self.cores = cores
+        self.item_ids = np.empty(0, dtype=np.int64)
+        self.neighbors = np.empty((0, k), dtype=np.int32)
+        self.similarities = np.empty((0, k), dtype=np.float32)
+        if path is not None:
+            self.load(path)
+
+    def fit(self, data, media_ids=None):
+        """ Compute the neighbours of every track
+
+        Parameters
+        ----------
+        data: Pandas dataframe with the columns user_id and media_id (only the
+              rows with is_listened == 1 are used if the column exists)
+        media_ids: Other tracks to index, without co-listens (ex: the tracks
+                   of the test set)
+        """
+        if 'is_listened' in data.columns:
+            data = data[data['is_listened'] == 1]
+
+        item_ids = data['media_id'].values
+        if media_ids is not None:
+            item_ids = np.concatenate((item_ids, np.asarray(media_ids)))
+        self.item_ids = np.unique(item_ids)
+
+        # Binary users x items matrix
+        user_codes = pd.factorize(data['user_id'].values)[0]
+        item_codes = np.searchsorted(self.item_ids, data['media_id'].values)
+        X = csr_matrix((np.ones(len(user_codes), dtype=np.float32),
+                        (user_codes, item_codes)),
+                       shape=(user_codes.max() + 1 if len(user_codes) else 0,
+                              len(self.item_ids)))
+        X.sum_duplicates()
+        X.data[:] = 1
+        X_csc = X.tocsc()
+        norms = np.sqrt(np.asarray(X.sum(axis=0)).ravel())
+
+        blocks = [(start, min(start + self.block_size, len(self.item_ids)), self.k)
+                  for start in range(0, len(self.item_ids), self.block_size)]
+        if self.cores > 1:
+            with Pool(self.cores, initializer=_init_worker,
+                      initargs=(X, X_csc, norms)) as p:
+                results = p.map(_block_top_k, blocks)
+        else:
+            results = [block_top_k(X, X_csc, norms, *block) for block in blocks]
+
+        if results:
+            self.neighbors = np.concatenate([r[0] for r in results])
+            self.similarities = np.concatenate([r[1] for r in results])
+
+    def dump(self, path):
+        """ Save the index: one .npy file per array
+
+        Parameters
+        ----------
+        path: Directory to create
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        save_npy(os.path.join(path, 'item_ids.npy'), self.item_ids)
+        save_npy(os.path.join(path, 'neighbors.npy'), self.neighbors)
+        save_npy(os.path.join(path, 'similarities.npy'), self.similarities)
+
+    def load(self, path):
+        """ Load (memory-mapped) an index saved with dump
+
+        Parameters
+        ----------
+        path: Directory written by dump
+        """
+        self.item_ids = np.load(os.path.join(path, 'item_ids.npy'), mmap_mode='r')
+        self.neighbors = np.load(os.path.join(path, 'neighbors.npy'), mmap_mode='r')
+        self.similarities = np.load(os.path.join(path, 'similarities.npy'),
+                                    mmap_mode='r')
+        self.k = self.neighbors.shape[1]
+
+    def fingerprint(self):
+        """ Hash of the index, used as a cache key of the features
+        """
+        sha = hashlib.sha1()
+        for values in [self.item_ids, self.neighbors, self.similarities]:
+            sha.update(np.ascontiguousarray(values).tobytes())
+        return(sha.hexdigest())
+
+    def get_neighbors(self, media_id):
+        """ Neighbours of a track
+
+        Output
+        ------
+        neighbors: Pandas series {media_id: similarity}, most similar first
+        """
+        i = np.searchsorted(self.item_ids, media_id)
+        if i == len(self.item_ids) or self.item_ids[i] != media_id:
+            return(pd.Series(dtype=np.float32))
+        found = self.neighbors[i] >= 0
+        return(pd.Series(self.similarities[i][found],
+                         index=self.item_ids[self.neighbors[i][found]]))
+
+    def similarity_to_listened(self, history, user_ids, media_ids,
+                               batch_size=100000):
+        """ Similarity of each track to the tracks listened by its user
+
+        Parameters
+        ----------
+        history: History instance of the listened tracks
+        user_ids: Array of user ids
+        media_ids: Array of tracks, one per user id
+        batch_size: Number of rows processed at once
+
+        Output
+        ------
+        max_similarity: Similarity to the most similar track listened by the
+                        user, 0 if none of the neighbours was listened
+        mean_similarity: Mean similarity to the tracks listened by the user
+                         (similarities outside of the k neighbours count as 0)
+        """
+        user_ids, media_ids = np.asarray(user_ids), np.asarray(media_ids)
+        max_similarity = np.zeros(len(user_ids), dtype=np.float32)
+        mean_similarity = np.zeros(len(user_ids), dtype=np.float32)
+        if len(self.item_ids) == 0:
+            return(max_similarity, mean_similarity)
+
+        membership = history.membership_index('media_id')
+        for start in range(0, len(user_ids), batch_size):
+            users = user_ids[start:start + batch_size]
+            items = media_ids[start:start + batch_size]
+
+            rows = np.minimum(np.searchsorted(self.item_ids, items),
+                              len(self.item_ids) - 1)
+            found = self.item_ids[rows] == items
+            neighbors = np.asarray(self.neighbors[rows])
+            sims = np.where(found[:, None] & (neighbors >= 0),
+                            self.similarities[rows], 0)
+            listened = membership.contains(
+                np.repeat(users, self.k),
+                self.item_ids[np.maximum(neighbors, 0)].ravel())
+            sims = np.where(listened.reshape(sims.shape), sims, 0)
+
+            codes = np.minimum(np.searchsorted(membership.owner_ids, users),
+                               max(len(membership.owner_ids) - 1, 0))
+            nb_listened = np.diff(membership.ptr)[codes] if len(membership) \
+                else np.zeros(len(users))
+            max_similarity[start:start + batch_size] = sims.max(axis=1)
+            mean_similarity[start:start + batch_size] = (
+                sims.sum(axis=1) / np.maximum(nb_listened, 1))
+        return(max_similarity, mean_similarity)
+
+
+if __name__ == '__main__':
+    """
+    Here is how to build the similarity index and use it as a feature
+    """
+    from features.History import History
+
+    train = pd.read_csv('./data/train.csv')
+    test = pd.read_csv('./data/test.csv')
+
+    similarity = ItemSimilarity(k=20, cores=4)
+    similarity.fit(train, media_ids=test.media_id.values)
+    similarity.dump('./data/item_similarity')
+
+    hist = History(path='./data/history')
+    max_sim, mean_sim = similarity.similarity_to_listened(
+        hist, test.user_id.values, test.media_id.values)
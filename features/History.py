@@ -1,9 +1,12 @@
+import os
 import json
+import hashlib
 import pandas as pd
 import numpy as np
-from collections import Counter
+from io import StringIO
+from collections.abc import Mapping
 from datetime import datetime
-from multiprocess import Pool
+from multiprocessing import Pool, shared_memory
 import calendar
 
 #########################
@@ -34,96 +37,633 @@ def date_format(input_date):
         raise TypeError("the input to date_formats should be of type basestring, datetime.datetime or int/long")
     return ts, dt, st
 
-def agg(id, data_by_user):
+def to_shared_memory(values):
+    """
+    Copy an array into a new shared memory block
+    :param values: np.array | array to share
+    :return: tuple(SharedMemory, tuple) | the block (to close and unlink once
+             done) and the (name, shape, dtype) needed to attach to it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+    return shm, (shm.name, values.shape, values.dtype.str)
+
+def save_npy(filename, values):
+    """
+    Save an array as a .npy file, written to a temporary file first and then
+    moved to filename: arrays memory-mapped from the former file (ex: a
+    History loaded from the directory it is dumped to) remain valid
+    :param filename: string | path of the .npy file
+    :param values: np.array | array to save
+    :return: None
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp, filename)
+
+def _sort_users(codes, ts, lo, hi):
+    """
+    Sort by (user, ts_listen) the events of the users lo to hi - 1
+    :param codes: np.array | code of the user of each event (rank of its id)
+    :param ts: np.array | ts_listen of each event
+    :param lo: int | code of the first user
+    :param hi: int | code after the last user
+    :return: np.array | positions of the events of these users, sorted
+                        (int32 if they fit: 4 bytes per event)
+    """
+    dtype = np.int32 if len(codes) <= np.iinfo(np.int32).max else np.int64
+    rows = np.flatnonzero((codes >= lo) & (codes < hi)).astype(dtype)
+    users, times = codes[rows] - lo, ts[rows]
+    if len(rows) == 0:
+        return rows
+    if times.dtype.kind in "iu":
+        # A single int64 key (user, ts_listen) when it can't overflow
+        t0 = int(times.min())
+        span = int(times.max()) - t0 + 1
+        if (hi - lo) * span < 2 ** 62:
+            keys = users.astype(np.int64) * span + (times.astype(np.int64) - t0)
+            return rows[np.argsort(keys, kind="stable")]
+    return rows[np.lexsort((times, users))]
+
+def _attach_shared(desc, blocks):
+    """
+    View of an array shared with to_shared_memory
+    :param desc: tuple | (name, shape, dtype) of the array
+    :param blocks: list | the block is appended to it, to be closed once the
+                          view is no longer used
+    :return: np.array | view of the shared array
+    """
+    shm = shared_memory.SharedMemory(name=desc[0])
+    blocks.append(shm)
+    return np.ndarray(desc[1], dtype=desc[2], buffer=shm.buf)
+
+def _sort_user_range(args):
     """
     Intermediary function used for multiprocessing
+    Sorts the events of the users lo to hi - 1 (see _sort_users) and writes
+    their columns, from start, into the shared sorted columns: nothing is
+    sent back
+    """
+    codes_desc, columns_desc, sorted_desc, lo, hi, start = args
+    blocks = []
+    try:
+        codes = _attach_shared(codes_desc, blocks)
+        columns = {col: _attach_shared(desc, blocks)
+                   for col, desc in columns_desc.items()}
+        rows = _sort_users(codes, columns["ts_listen"], lo, hi)
+        for col, desc in sorted_desc.items():
+            _attach_shared(desc, blocks)[start:start + len(rows)] = \
+                columns[col][rows]
+        del codes, columns
+    finally:
+        for shm in blocks:
+            shm.close()
+
+def top_n_values(values, n=10):
+    """
+    Get the n most frequent values of an array
+    Ties are broken by the most recently seen value first, as
+    Counter.most_common over the newest-first history
+    :param values: np.array | values to rank, oldest first
+    :param n: int | top elements of the list
+    :return: np.array | the n most frequent values, most frequent first
+    """
+    uniques, newest, counts = np.unique(values[::-1], return_index=True,
+                                        return_counts=True)
+    order = np.lexsort((newest, -counts))[:n]
+    return uniques[order]
+
+def dense_codes(*arrays):
+    """
+    Map the values of several arrays to dense codes shared by all the arrays
+    :param arrays: np.array | arrays of values
+    :return: tuple | (number of distinct values, code arrays...)
+    """
+    uniques, codes = np.unique(np.concatenate(arrays), return_inverse=True)
+    splits = np.cumsum([len(a) for a in arrays])[:-1]
+    return (len(uniques),) + tuple(np.split(codes.astype(np.int64), splits))
+
+def count_events(event_groups, event_ts, query_groups, end_ts, start_ts=None):
+    """
+    For each query, count the events of the same group such that
+    start_ts <= ts < end_ts, with a single sort of the events
+    :param event_groups: np.array | int group of each event (ex: user)
+    :param event_ts: np.array | timestamp of each event
+    :param query_groups: np.array | int group of each query
+    :param end_ts: np.array | exclusive upper bound of each query
+    :param start_ts: np.array | inclusive lower bound of each query (optional),
+                                of shape (n_queries, k) to count k windows
+                                at once
+    :return: np.array | number of events of each query, of the shape of
+             start_ts if given
+    """
+    event_groups, event_ts = np.asarray(event_groups), np.asarray(event_ts)
+    query_groups = np.asarray(query_groups)
+    end_ts = np.asarray(end_ts, dtype=np.int64)
+    if start_ts is not None:
+        start_ts = np.asarray(start_ts, dtype=np.int64)
+    shape = (len(query_groups),) if start_ts is None else start_ts.shape
+    if len(event_groups) == 0 or len(query_groups) == 0:
+        return np.zeros(shape, dtype=np.int64)
+
+    uniques, event_codes = np.unique(event_groups, return_inverse=True)
+    query_codes = np.minimum(np.searchsorted(uniques, query_groups),
+                             len(uniques) - 1)
+    found = uniques[query_codes] == query_groups
+
+    # Encode (group, ts_listen) into a single sortable int64 key
+    t0 = int(event_ts.min())
+    span = int(event_ts.max()) - t0 + 1
+    keys = np.sort(event_codes.astype(np.int64) * span + (event_ts - t0))
+    base = query_codes.astype(np.int64) * span
+    end = base + np.clip(end_ts - t0, 0, span)
+    if start_ts is None:
+        start = base
+    else:
+        if start_ts.ndim == 2:
+            base, end, found = base[:, None], end[:, None], found[:, None]
+        start = base + np.clip(start_ts - t0, 0, span)
+    counts = np.searchsorted(keys, end) - np.searchsorted(keys, start)
+    return np.where(found, np.maximum(counts, 0), 0)
+
+class MembershipIndex(object):
+    """
+    Compact index of the set of values (tracks, artists, ...) of each owner
+    (user, cluster, ...): the values of each owner are stored as a sorted
+    int32 slice, looked up by binary search
     """
-    df_user = data_by_user.get_group(id).drop("user_id",axis=1)
-    df_user.sort(columns=['ts_listen'], ascending=False, inplace=True)
-    return id, df_user
+
+    def __init__(self, owners, values):
+        """
+        Constructor of the class
+        :param owners: np.array | owner of each event
+        :param values: np.array | non negative value of each event
+        """
+        owners, values = np.asarray(owners), np.asarray(values, dtype=np.int64)
+        self.owner_ids, owner_codes = np.unique(owners, return_inverse=True)
+        self._base = int(values.max()) + 1 if len(values) > 0 else 1
+
+        # Sorted unique (owner, value) keys
+        self._keys = np.unique(owner_codes.astype(np.int64) * self._base +
+                               values)
+        counts = np.bincount(self._keys // self._base,
+                             minlength=len(self.owner_ids))
+        self.ptr = np.zeros(len(self.owner_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.ptr[1:])
+        dtype = np.int32 if self._base <= np.iinfo(np.int32).max else np.int64
+        self.values = (self._keys % self._base).astype(dtype)
+
+    def __len__(self):
+        return len(self.owner_ids)
+
+    def dump(self, path, name):
+        """
+        Save the index as .npy files
+        :param path: string | directory of the files
+        :param name: string | prefix of the files
+        :return: None
+        """
+        for attr in ["owner_ids", "ptr", "values", "_keys", "_base"]:
+            save_npy(os.path.join(path, "%s_%s.npy" % (name, attr.strip("_"))),
+                     getattr(self, attr))
+
+    @classmethod
+    def load(cls, path, name):
+        """
+        Load (memory-mapped) an index saved with dump
+        :param path: string | directory of the files
+        :param name: string | prefix of the files
+        :return: MembershipIndex instance
+        """
+        index = cls.__new__(cls)
+        for attr in ["owner_ids", "ptr", "values", "_keys"]:
+            setattr(index, attr, np.load(
+                os.path.join(path, "%s_%s.npy" % (name, attr.strip("_"))),
+                mmap_mode="r"))
+        index._base = int(np.load(os.path.join(path, "%s_base.npy" % name)))
+        return index
+
+    def get(self, owner):
+        """
+        Get the values of an owner
+        :param owner: int | id of the owner
+        :return: np.array | sorted values, empty if the owner is unknown
+        """
+        i = np.searchsorted(self.owner_ids, owner)
+        if i == len(self.owner_ids) or self.owner_ids[i] != owner:
+            return self.values[:0]
+        return self.values[self.ptr[i]:self.ptr[i + 1]]
+
+    def contains(self, owners, values):
+        """
+        Check a whole batch of (owner, value) pairs at once
+        :param owners: list, array | ids of the owners
+        :param values: list, array | values, one per owner
+        :return: np.array | boolean array, True if the value belongs to the
+                 set of its owner
+        """
+        owners = np.asarray(owners)
+        values = np.asarray(values, dtype=np.int64)
+        found = np.zeros(len(owners), dtype=bool)
+        if len(self._keys) == 0:
+            return found
+
+        codes = np.minimum(np.searchsorted(self.owner_ids, owners),
+                           len(self.owner_ids) - 1)
+        valid = ((self.owner_ids[codes] == owners) & (values >= 0) &
+                 (values < self._base))
+        keys = codes.astype(np.int64) * self._base + values
+        pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found[valid] = self._keys[pos[valid]] == keys[valid]
+        return found
+
+class UserHistories(Mapping):
+    """
+    Read-only dict-like view {user_id: pd.DataFrame} over a History instance
+    The DataFrame of a user is built from its slice of the columnar storage
+    the first time it is accessed, then cached
+    """
+
+    def __init__(self, history):
+        self._history = history
+        self._cache = dict()
+
+    def __getitem__(self, id):
+        if id not in self._cache:
+            columns = self._history.get_user_arrays(id)
+            # Most recent listens first
+            self._cache[id] = pd.DataFrame(
+                {col: values[::-1] for col, values in columns.items()})
+        return self._cache[id]
+
+    def __iter__(self):
+        return iter(self._history.user_ids.tolist())
+
+    def __len__(self):
+        return len(self._history.user_ids)
+
+    def __contains__(self, id):
+        return self._history.user_index(id) is not None
 
 #########################
 #     History Class     #
 #########################
 
 class History(object):
-    def __init__(self, users=None, path=None):
+    def __init__(self, users=None, path=None, retention_days=None):
         """
         Constructor of the class
         :param users: list, array | collection of users to get the history from
-        :param path: string | path to the .json file containing the history.
+        :param path: string | path to the directory written by dump (or to a
+                              legacy .json file) containing the history.
                               Favour this case when you've already fitted and
                               saved an history instance on all the users.
+        :param retention_days: int, float | if given, only the events of the
+                                            last retention_days days (relative
+                                            to the most recent event) are kept
         """
         self.path = path
-        if path is None:
-            self.users = list(set(users))
-            self.history = dict()
-        else:
-            with open(path, "r") as f:
-                json_history = json.load(f)
-                json_history = map(lambda d: (d["id"], d["history"][0]),
-                                   json_history)
-                self.history = {int(k): pd.read_json(v) for k, v in
-                                json_history}
-            self.users = [k for k in self.history]
+        self.retention_days = retention_days
+        self.users = None if users is None else list(set(users))
+
+        # Columnar storage: the events of the user self.user_ids[i] are the
+        # rows self.user_ptr[i]:self.user_ptr[i + 1] of each column, sorted
+        # by ts_listen
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.user_ptr = np.zeros(1, dtype=np.int64)
+        self.columns = {col: np.empty(0, dtype=np.int64)
+                        for col in self.DATA_COLS}
+        self.history = UserHistories(self)
+        self._top_n = dict()
+        self._membership = dict()
+
+        if path is not None:
+            if os.path.isdir(path):
+                self.load(path)
+            else:
+                self._load_json(path)
+            self.users = self.user_ids.tolist()
 
     # The fields kept for the history, add any if needed
     COL_NAMES = ["user_id", "ts_listen", "media_id", "artist_id", "is_listened"]
+    # The fields stored per event (user_id is encoded by user_ptr)
+    DATA_COLS = COL_NAMES[1:]
+    # Fields also kept when present in the data (genre_id is used to count the
+    # similar tracks listened recently)
+    OPTIONAL_COL_NAMES = ["genre_id"]
 
     def dump(self, path):
-        serializable_history = [{"id": str(k), "history": [
-            self.history[k].to_json(path_or_buf=None)]} for k in self.history]
-        with open(path, "w") as f:
-            json.dump(serializable_history, f)
+        """
+        Save the instance in a binary format: a directory containing one .npy
+        file per column plus the user_ids/user_ptr offsets index
+        :param path: string | path of the directory to create
+        :return: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        save_npy(os.path.join(path, "user_ids.npy"), self.user_ids)
+        save_npy(os.path.join(path, "user_ptr.npy"), self.user_ptr)
+        for col, values in self.columns.items():
+            save_npy(os.path.join(path, col + ".npy"), values)
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"columns": list(self.columns)}, f)
+
+    def load(self, path):
+        """
+        Load an instance saved with dump
+        The columns are memory-mapped: only the pages of the users that are
+        accessed are actually read from the disk
+        :param path: string | path of the directory written by dump
+        :return: inplace | modifies the storage
+        """
+        with open(os.path.join(path, "index.json"), "r") as f:
+            col_names = json.load(f)["columns"]
+        self._set_data(
+            np.load(os.path.join(path, "user_ids.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "user_ptr.npy"), mmap_mode="r"),
+            {col: np.load(os.path.join(path, col + ".npy"), mmap_mode="r")
+             for col in col_names})
+
+    def _load_json(self, path):
+        """
+        Load an instance from the former .json format: one serialized
+        DataFrame per user
+        :param path: string | path to the .json file
+        :return: inplace | modifies the storage
+        """
+        with open(path, "r") as f:
+            json_history = json.load(f)
+            json_history = map(lambda d: (d["id"], d["history"][0]),
+                               json_history)
+            history = {int(k): pd.read_json(StringIO(v)) for k, v in
+                       json_history}
+        data = pd.concat([df.assign(user_id=k) for k, df in
+                          history.items()], ignore_index=True)
+        self._fit_sorted(data)
+
+    def fingerprint(self):
+        """
+        Get a hash of the stored events, used as a cache key of the features
+        computed from this history
+        :return: str | hex digest
+        """
+        sha = hashlib.sha1()
+        for values in [self.user_ids, self.user_ptr] + [
+                self.columns[col] for col in sorted(self.columns)]:
+            sha.update(np.ascontiguousarray(values).tobytes())
+        return sha.hexdigest()
+
+    def _check_columns(self, data):
+        if any(col not in data.columns for col in self.COL_NAMES):
+            raise IOError(
+                "The dataframe must contain the fields: " +
+                ", ".join(self.COL_NAMES))
+
+    def _kept_cols(self, data):
+        return self.COL_NAMES + [col for col in self.OPTIONAL_COL_NAMES
+                                 if col in data.columns]
+
+    def _set_data(self, user_ids, user_ptr, columns):
+        """
+        Replace the columnar storage and drop everything cached on the old one
+        :param user_ids: np.array | sorted unique user ids
+        :param user_ptr: np.array | offsets of each user, of size len(user_ids) + 1
+        :param columns: dict | {column: np.array} sorted by (user_id, ts_listen)
+        :return: inplace | modifies the storage
+        """
+        self.user_ids = user_ids
+        self.user_ptr = user_ptr
+        self.columns = columns
+        self.history = UserHistories(self)
+        self._top_n = dict()
+        self._membership = dict()
+
+    def _fit_sorted(self, data):
+        """
+        Sort the events by (user_id, ts_listen) and store them
+        :param data: pd.DataFrame | contains the fields COL_NAMES, all the
+                                    other fields are stored as well
+        :return: inplace | modifies the storage
+        """
+        user_col = data["user_id"].values
+        order = np.lexsort((data["ts_listen"].values, user_col))
+        user_ids, counts = np.unique(user_col, return_counts=True)
+        user_ptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=user_ptr[1:])
+        self._set_data(user_ids, user_ptr,
+                       {col: data[col].values[order] for col in data.columns
+                        if col != "user_id"})
 
     def fit_multiproc(self, data, cores=4):
         """
             Computes the listening history for all the users in self.users
         using multiple cores
-        /!\ Make sure to install multiprocess 'pip install multiprocess'
+        The users are numbered in one pass (pd.factorize) and their offsets
+        counted with np.bincount, then the users are split into ranges of
+        about the same number of events, sorted in parallel: each worker
+        selects the events of its users from shared memory, sorts them by
+        (user, ts_listen) and writes them at the offsets of its users in
+        shared sorted columns.
+        The result is exactly the one of fit
         :param data: pd.Dataframe | data form which to get the history
         :param cores: int | number of cores to use
-        :return: in place, modifies self.history
+        :return: inplace | modifies the storage
         """
-        if any(col not in data.columns for col in self.COL_NAMES):
-            raise IOError(
-                "The dataframe must contain the fields: " + self.COL_NAMES)
+        self._check_columns(data)
 
-        data = data[self.COL_NAMES]
-        data_by_user = data.groupby("user_id")
+        data = data[self._kept_cols(data)]
+        if self.users is not None:
+            data = data[data["user_id"].isin(self.users)]
 
-        # Multithreaded computing
-        p = Pool(cores)  # swith to max_cores
-        tmp = p.map(lambda x: agg(x, data_by_user), self.users)
-        p.close()
+        # Codes of the users in the order of their ids, and their offsets
+        codes, user_ids = pd.factorize(data["user_id"].values, sort=True)
+        user_ids = np.asarray(user_ids)
+        if len(user_ids) <= np.iinfo(np.int32).max:
+            codes = codes.astype(np.int32)
+        user_ptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(user_ids)),
+                  out=user_ptr[1:])
+        columns = {col: data[col].values for col in data.columns
+                   if col != "user_id"}
 
-        # Update attribute
-        for id, df in tmp:
-            self.history[id] = df
+        # Ranges of users with about the same number of events
+        nb_ranges = min(4 * cores if cores > 1 else 1, len(user_ids))
+        bounds = np.searchsorted(
+            user_ptr, np.linspace(0, user_ptr[-1], nb_ranges + 1))
+        bounds = np.unique(np.minimum(bounds, len(user_ids)))
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        if cores > 1 and len(ranges) > 1 and \
+                not any(values.dtype.hasobject for values in columns.values()):
+            blocks = []
+            try:
+                codes_shm, codes_desc = to_shared_memory(codes)
+                blocks.append(codes_shm)
+                columns_desc, sorted_desc = dict(), dict()
+                for col, values in columns.items():
+                    shm, columns_desc[col] = to_shared_memory(values)
+                    blocks.append(shm)
+                    shm = shared_memory.SharedMemory(
+                        create=True, size=max(values.nbytes, 1))
+                    blocks.append(shm)
+                    sorted_desc[col] = (shm.name, values.shape, values.dtype.str)
+                with Pool(cores) as p:
+                    p.map(_sort_user_range,
+                          [(codes_desc, columns_desc, sorted_desc, lo, hi,
+                            user_ptr[lo]) for lo, hi in ranges])
+                sorted_columns = dict()
+                for col, desc in sorted_desc.items():
+                    shm = shared_memory.SharedMemory(name=desc[0])
+                    sorted_columns[col] = np.ndarray(
+                        desc[1], dtype=desc[2], buffer=shm.buf).copy()
+                    shm.close()
+            finally:
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
+        else:
+            order = np.concatenate([_sort_users(codes, columns["ts_listen"],
+                                                lo, hi) for lo, hi in ranges]) \
+                if ranges else np.empty(0, dtype=np.int64)
+            sorted_columns = {col: values[order]
+                              for col, values in columns.items()}
+
+        self._set_data(user_ids, user_ptr, sorted_columns)
+        self._apply_retention()
 
     def fit(self, data):
         """
         Fit the instance to the data
-        /!\ Can take a lot of time to fit depending on the training data
+        All the events are stored in a single set of columns sorted by
+        (user_id, ts_listen), the events of a user being a contiguous slice
 
         :param data: pd.Dataframe | data to get the history from
-        :return: inplace | modifies self.history
+        :return: inplace | modifies the storage
         """
+        self._check_columns(data)
 
-        if any(col not in data.columns for col in self.COL_NAMES):
-            raise IOError(
-                "The dataframe must contain the fields: " + self.COL_NAMES)
+        data = data[self._kept_cols(data)]
+        if self.users is not None:
+            data = data[data["user_id"].isin(self.users)]
+        self._fit_sorted(data)
+        self._apply_retention()
+
+    def append(self, data):
+        """
+        Add new events to a fitted instance without refitting it
+        Events of unknown users create new users. The new events are sorted
+        and merged into the existing columns, so the result is the same as
+        fitting the instance on the old and new events at once
+        :param data: pd.Dataframe | new events
+        :return: inplace | modifies the storage
+        """
+        self._check_columns(data)
+        if len(self.user_ids) == 0:
+            self._fit_sorted(data[self._kept_cols(data)])
+            if self.users is not None:
+                self.users = list(set(self.users).union(self.user_ids.tolist()))
+            self._apply_retention()
+            return
+        if any(col not in data.columns for col in self.columns):
+            raise IOError("The dataframe must contain the fields: " +
+                          ", ".join(self.columns))
+
+        new_users = data["user_id"].values
+        new_ts = data["ts_listen"].values.astype(np.int64)
+        old_ts = self.columns["ts_listen"].astype(np.int64)
+        if len(new_ts) == 0:
+            return
+
+        user_ids = np.union1d(self.user_ids, new_users)
+        old_rows = np.searchsorted(user_ids, self.user_ids)
+        old_rows = np.repeat(old_rows, np.diff(self.user_ptr))
+        new_rows = np.searchsorted(user_ids, new_users)
+
+        # Encode (user, ts_listen) into a single sortable int64 key
+        all_ts = np.concatenate((new_ts, old_ts))
+        t0 = int(all_ts.min())
+        span = int(all_ts.max()) - t0 + 1
+        old_keys = old_rows.astype(np.int64) * span + (old_ts - t0)
+        new_keys = new_rows.astype(np.int64) * span + (new_ts - t0)
+
+        order = np.argsort(new_keys, kind="mergesort")
+        positions = np.searchsorted(old_keys, new_keys[order], side="right")
+        columns = {col: np.insert(self.columns[col], positions,
+                                  data[col].values[order])
+                   for col in self.columns}
+
+        counts = (np.bincount(old_rows, minlength=len(user_ids)) +
+                  np.bincount(new_rows, minlength=len(user_ids)))
+        user_ptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=user_ptr[1:])
+        self._set_data(user_ids, user_ptr, columns)
+
+        if self.users is not None:
+            self.users = list(set(self.users).union(new_users.tolist()))
+        self._apply_retention()
 
-        data = data[self.COL_NAMES]
-        data_by_user = data.groupby("user_id")
+    def evict(self, before_date):
+        """
+        Remove the events older than a given date
+        Users left without any event are removed
+        :param before_date: int, float, str, datetime | events strictly
+                                                       before are removed
+        :return: inplace | modifies the storage
+        """
+        cutoff = date_format(before_date)[0]
+        keep = self.columns["ts_listen"] >= cutoff
+        if keep.all():
+            return
+
+        counts = np.bincount(self.user_rows()[keep],
+                             minlength=len(self.user_ids))
+        alive = counts > 0
+        user_ptr = np.zeros(alive.sum() + 1, dtype=np.int64)
+        np.cumsum(counts[alive], out=user_ptr[1:])
+        self._set_data(self.user_ids[alive], user_ptr,
+                       {col: values[keep] for col, values in
+                        self.columns.items()})
+
+    def _apply_retention(self):
+        """
+        Evict the events outside of the retention window, if any
+        """
+        if self.retention_days is None or len(self.columns["ts_listen"]) == 0:
+            return
+        last = int(self.columns["ts_listen"].max())
+        self.evict(last - int(self.retention_days * 24 * 3600))
 
-        # Update attribute
-        for id in self.users:
-            df_user = data_by_user.get_group(id).drop("user_id", axis=1)
-            df_user.sort(columns=['ts_listen'], ascending=False,
-                            inplace=True)
-            self.history[id] = df_user
+    def user_index(self, id):
+        """
+        Get the position of a user in self.user_ids
+        :param id: int | id of the user
+        :return: int or None | position of the user, None if unknown
+        """
+        i = np.searchsorted(self.user_ids, id)
+        if i < len(self.user_ids) and self.user_ids[i] == id:
+            return int(i)
+        return None
+
+    def get_user_arrays(self, id):
+        """
+        Get the events of a user, sorted by ts_listen, without copying them
+        :param id: int | id of the user
+        :return: dict | {column: np.array} views on the columnar storage
+        """
+        i = self.user_index(id)
+        if i is None:
+            raise KeyError(id)
+        start, end = self.user_ptr[i], self.user_ptr[i + 1]
+        return {col: values[start:end] for col, values in self.columns.items()}
+
+    def _get_current_arrays(self, id, start_date, end_date):
+        columns = self.get_user_arrays(id)
+        start, end = date_format(start_date)[0], date_format(end_date)[0]
+        ts = columns["ts_listen"]
+        lo = np.searchsorted(ts, start, side="left")
+        hi = np.searchsorted(ts, end, side="right")
+        return {col: values[lo:hi] for col, values in columns.items()}
 
     def get_current_history(self, id, start_date, end_date):
         """
@@ -133,11 +673,17 @@ class History(object):
         :param end_date: int, float | end of the history
         :return: pd.DataFrame | history of the given user between the two dates
         """
-        user_history = self.history[id]
-        start, end = date_format(start_date)[0], date_format(end_date)[0]
-        user_history = user_history[(user_history["ts_listen"] <= end) & (
-        user_history["ts_listen"] >= start)]
-        return user_history
+        columns = self._get_current_arrays(id, start_date, end_date)
+        return pd.DataFrame({col: values[::-1]
+                             for col, values in columns.items()})
+
+    def _get_top(self, key, id, n, start_date, end_date):
+        if start_date is not None and end_date is not None:
+            columns = self._get_current_arrays(id, start_date, end_date)
+        else:
+            columns = self.get_user_arrays(id)
+        listened = columns[key][columns["is_listened"] == 1]
+        return top_n_values(listened, n).tolist()
 
     def get_top_tracks(self, id, n=10, start_date=None, end_date=None):
         """
@@ -148,12 +694,7 @@ class History(object):
         :param end_date: int, float | end of the history
         :return: list | list of the n top tracks listened by th user
         """
-        user_history = self.history[id]
-        if start_date is not None and end_date is not None:
-            user_history = self.get_current_history(id, start_date, end_date)
-        user_history = user_history[user_history.is_listened == 1]
-        ranking = Counter(user_history["media_id"].values).most_common(n)
-        return [t[0] for t in ranking]
+        return self._get_top("media_id", id, n, start_date, end_date)
 
     def get_top_artists(self, id, n=10, start_date=None, end_date=None):
         """
@@ -164,12 +705,171 @@ class History(object):
         :param end_date: int, float | end of the history
         :return: list | list of the n top artists listened by th user
         """
-        user_history = self.history[id]
-        if start_date is not None and end_date is not None:
-            user_history = self.get_current_history(id, start_date, end_date)
-        user_history = user_history[user_history.is_listened == 1]
-        ranking = Counter(user_history["artist_id"].values).most_common(n)
-        return [t[0] for t in ranking]
+        return self._get_top("artist_id", id, n, start_date, end_date)
+
+    @staticmethod
+    def _window(start_date, end_date):
+        if start_date is None or end_date is None:
+            return None
+        return date_format(start_date)[0], date_format(end_date)[0]
+
+    def user_rows(self):
+        """
+        Get the position in self.user_ids of the user of each stored event
+        :return: np.array | array of the size of the columns
+        """
+        return np.repeat(np.arange(len(self.user_ids)), np.diff(self.user_ptr))
+
+    def lookup_users(self, user_ids):
+        """
+        Vectorized version of user_index
+        :param user_ids: list, array | ids of the users
+        :return: tuple(np.array, np.array) | positions of the users in
+                 self.user_ids (clipped to a valid position) and whether
+                 each user is known
+        """
+        user_ids = np.asarray(user_ids)
+        rows = np.searchsorted(self.user_ids, user_ids)
+        rows = np.minimum(rows, max(len(self.user_ids) - 1, 0))
+        known = np.zeros(len(user_ids), dtype=bool)
+        if len(self.user_ids) > 0:
+            known = self.user_ids[rows] == user_ids
+        return rows, known
+
+    def membership_index(self, key="media_id"):
+        """
+        Get the index of the tracks or artists listened (is_listened == 1) by
+        each user. The index is built on first call, then cached
+        :param key: str | "media_id" or "artist_id"
+        :return: MembershipIndex instance | owners being the users
+        """
+        if key not in self._membership:
+            listened = self.columns["is_listened"] == 1
+            self._membership[key] = MembershipIndex(
+                self.user_ids[self.user_rows()[listened]],
+                self.columns[key][listened])
+        return self._membership[key]
+
+    def contains(self, user_ids, values, key="media_id"):
+        """
+        Vectorized check of whether each user listened to a track or artist
+        :param user_ids: list, array | ids of the users
+        :param values: list, array | tracks or artists ids, one per user id
+        :param key: str | "media_id" or "artist_id"
+        :return: np.array | boolean array, False for unknown users
+        """
+        return self.membership_index(key).contains(user_ids, values)
+
+    def count_in_window(self, user_ids, values, ts_listen, window=3600,
+                        key="artist_id", listened_only=True):
+        """
+        Count, for each row, the events of the user with the same artist
+        (track, genre, ...) in the window [ts_listen - window, ts_listen)
+        :param user_ids: list, array | ids of the users
+        :param values: list, array | artists (tracks, genres...), one per user id
+        :param ts_listen: list, array | timestamps, one per user id
+        :param window: int, list | length of the window in seconds, or list of
+                                   lengths to count several windows at once
+        :param key: str | field of the history compared to values
+        :param listened_only: bool | only count the events with is_listened == 1
+        :return: np.array | counts, of shape (len(user_ids), len(window)) if
+                 window is a list
+        """
+        if key not in self.columns:
+            raise IOError("The history does not contain the field " + key)
+
+        ts_listen = np.asarray(ts_listen, dtype=np.int64)
+        if np.ndim(window) == 0:
+            start_ts = ts_listen - window
+        else:
+            start_ts = ts_listen[:, None] - np.asarray(window)[None, :]
+
+        event_rows = self.user_rows()
+        event_values, event_ts = self.columns[key], self.columns["ts_listen"]
+        if listened_only:
+            listened = self.columns["is_listened"] == 1
+            event_rows = event_rows[listened]
+            event_values, event_ts = event_values[listened], event_ts[listened]
+
+        rows, known = self.lookup_users(user_ids)
+        nb_values, event_values, values = dense_codes(event_values,
+                                                      np.asarray(values))
+        query_groups = np.where(known, rows * nb_values + values, -1)
+        return count_events(event_rows * nb_values + event_values,
+                            event_ts.astype(np.int64), query_groups,
+                            ts_listen, start_ts)
+
+    def top_n_matrix(self, key="media_id", n=10, start_date=None,
+                     end_date=None):
+        """
+        Get the n most listened tracks or artists of every user in one pass
+        (between two dates if needed). The result is cached
+        Ties are broken as in get_top_tracks and get_top_artists
+        :param key: str | "media_id" or "artist_id"
+        :param n: int | top elements of each list
+        :param start_date: int, float | start of the history
+        :param end_date: int, float | end of the history
+        :return: np.array | array of shape (len(self.user_ids), n), the row i
+                 holds the top n of self.user_ids[i], padded with -1
+        """
+        window = self._window(start_date, end_date)
+        cache_key = (key, n, window)
+        if cache_key in self._top_n:
+            return self._top_n[cache_key][0]
+
+        mask = self.columns["is_listened"] == 1
+        if window is not None:
+            ts = self.columns["ts_listen"]
+            mask &= (ts >= window[0]) & (ts <= window[1])
+        events = pd.DataFrame({"row": self.user_rows()[mask],
+                               "value": self.columns[key][mask],
+                               "position": np.flatnonzero(mask)})
+        stats = events.groupby(["row", "value"], sort=True)["position"].agg(
+            ["size", "max"])
+        rows = stats.index.get_level_values("row").values
+        values = stats.index.get_level_values("value").values
+
+        # Most listened first in each user, most recently listened first for
+        # ties (the events of a user are sorted by ts_listen)
+        order = np.lexsort((-stats["max"].values, -stats["size"].values, rows))
+        rows, values = rows[order], values[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < n
+
+        top = np.full((len(self.user_ids), n), -1, dtype=np.int64)
+        top[rows[keep], rank[keep]] = values[keep]
+
+        # Sorted (row, value) keys for the membership lookups of is_top_n
+        base = int(values.max()) + 1 if len(values) > 0 else 1
+        top_keys = np.sort(rows[keep].astype(np.int64) * base + values[keep])
+        self._top_n[cache_key] = (top, base, top_keys)
+        return top
+
+    def is_top_n(self, user_ids, values, key="media_id", n=10,
+                 start_date=None, end_date=None):
+        """
+        Vectorized check of whether each value is in the top n of its user
+        :param user_ids: list, array | ids of the users
+        :param values: list, array | tracks or artists ids, one per user id
+        :param key: str | "media_id" or "artist_id"
+        :param n: int | number of top elements
+        :param start_date: int, float | start of the history
+        :param end_date: int, float | end of the history
+        :return: np.array | boolean array, False for unknown users
+        """
+        self.top_n_matrix(key, n, start_date, end_date)
+        window = self._window(start_date, end_date)
+        _, base, top_keys = self._top_n[(key, n, window)]
+
+        rows, known = self.lookup_users(user_ids)
+        values = np.asarray(values, dtype=np.int64)
+        valid = known & (values >= 0) & (values < base)
+        keys = rows.astype(np.int64) * base + values
+        pos = np.minimum(np.searchsorted(top_keys, keys), max(len(top_keys) - 1, 0))
+        found = np.zeros(len(keys), dtype=bool)
+        if len(top_keys) > 0:
+            found = top_keys[pos] == keys
+        return valid & found
 
 
 if __name__ == "__main__":
@@ -184,13 +884,13 @@ if __name__ == "__main__":
     hist.fit(train)
 
     # Save the instance
-    hist.dump("Users/mohamed/Documents/GitHub/data/history_100_users.json")
+    hist.dump("Users/mohamed/Documents/GitHub/data/history_100_users")
 
-    # Load from existing json file
-    hist_loaded = History(path="Users/mohamed/Documents/GitHub/data/history_100_users.json")
+    # Load from an existing dump (memory-mapped)
+    hist_loaded = History(path="Users/mohamed/Documents/GitHub/data/history_100_users")
 
     # Multiprocessing
-    #hist.fit_multiproc(train, cores=4)
+    hist.fit_multiproc(train, cores=4)
 
     # Get the top-N artists and tracks
     user_id = 42
@@ -0,0 +1,141 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .features import BUCKET_RANKING, BUCKET_BPM, _bucketize
+
+
+class MetadataIndex(object):
+    """
+    Lookup tables of the tracks and albums metadata
+    Built once from the tracks and album genres dataframes, then used to get
+    the rank, tempo and genre of a whole column of ids in one vectorized join
+    (sorted ids + np.searchsorted) instead of a scan of the tables per row
+    """
+
+    def __init__(self, tracks_df=None, album_genres_df=None):
+        """
+        Constructor of the class
+        :param tracks_df: pd.DataFrame | the dataframe of tracks (id, rank, bpm)
+        :param album_genres_df: pd.DataFrame | dataframe mapping each album to
+                                               a genre (album_id, new_genre_name)
+        """
+        self.track_ids = np.empty(0, dtype=np.int64)
+        self.ranks = np.empty(0, dtype=float)
+        self.bpms = np.empty(0, dtype=float)
+        self.album_ids = np.empty(0, dtype=np.int64)
+        self.genre_codes = np.empty(0, dtype=np.int64)
+        self.genre_names = []
+
+        if tracks_df is not None:
+            # When an id appears several times, its first row is used
+            self.track_ids, first = np.unique(tracks_df['id'].values,
+                                              return_index=True)
+            self.ranks = tracks_df['rank'].values[first].astype(float)
+            self.bpms = tracks_df['bpm'].values[first].astype(float)
+
+        if album_genres_df is not None:
+            self.album_ids, first = np.unique(album_genres_df['album_id'].values,
+                                              return_index=True)
+            codes, names = pd.factorize(
+                album_genres_df['new_genre_name'].values[first])
+            self.genre_codes, self.genre_names = codes, list(names)
+
+    def fingerprint(self):
+        """
+        Get a hash of the lookup tables, used as a cache key of the features
+        computed from this index
+        :return: str | hex digest
+        """
+        sha = hashlib.sha1()
+        for values in [self.track_ids, self.ranks, self.bpms, self.album_ids,
+                       self.genre_codes]:
+            sha.update(np.ascontiguousarray(values).tobytes())
+        sha.update("\n".join(map(str, self.genre_names)).encode("utf-8"))
+        return sha.hexdigest()
+
+    @staticmethod
+    def _lookup(keys, ids):
+        """
+        Get the rows of ids in the sorted array keys
+        :param keys: np.array | sorted unique ids
+        :param ids: list, array | ids to look up
+        :return: tuple(np.array, np.array) | rows (clipped to a valid row)
+                 and whether each id was found
+        """
+        ids = np.asarray(ids)
+        if len(keys) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        rows = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+        return rows, keys[rows] == ids
+
+    def _get_track_values(self, values, track_ids):
+        rows, found = self._lookup(self.track_ids, track_ids)
+        result = np.full(len(rows), np.nan)
+        result[found] = values[rows[found]]
+        return result
+
+    def get_ranks(self, track_ids):
+        """
+        :param track_ids: list, array | track ids
+        :return: np.array | rank of each track, NaN if unknown
+        """
+        return self._get_track_values(self.ranks, track_ids)
+
+    def get_bpms(self, track_ids):
+        """
+        :param track_ids: list, array | track ids
+        :return: np.array | bpm of each track, NaN if unknown
+        """
+        return self._get_track_values(self.bpms, track_ids)
+
+    def get_ranking_buckets(self, track_ids):
+        """
+        Vectorized version of get_ranking_bucket
+        :param track_ids: list, array | track ids
+        :return: pd.Categorical | buckets describing how famous the tracks are,
+                 "not_famous" for unknown tracks
+        """
+        ranks = self.get_ranks(track_ids)
+        return _bucketize(np.nan_to_num(ranks, nan=0), BUCKET_RANKING)
+
+    def get_track_tempos(self, track_ids):
+        """
+        Vectorized version of get_track_tempo
+        :param track_ids: list, array | track ids
+        :return: pd.Categorical | tempos of the tracks, "Unknown" for unknown
+                 tracks
+        """
+        bpms = np.round(self.get_bpms(track_ids))
+        buckets = _bucketize(np.nan_to_num(bpms, nan=0), BUCKET_BPM)
+        buckets = buckets.add_categories("Unknown")
+        buckets[np.isnan(bpms)] = "Unknown"
+        return buckets
+
+    def get_genres(self, album_ids):
+        """
+        Vectorized version of get_genre
+        :param album_ids: list, array | album ids
+        :return: pd.Categorical | genres of the albums, "Unknown" for unknown
+                 albums
+        """
+        rows, found = self._lookup(self.album_ids, album_ids)
+        categories = self.genre_names + ["Unknown"]
+        codes = np.full(len(rows), len(categories) - 1, dtype=np.int64)
+        codes[found] = self.genre_codes[rows[found]]
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    def transform(self, data, track_col="media_id", album_col="album_id"):
+        """
+        Get the metadata features of a whole dataframe
+        :param data: pd.DataFrame | contains the track and album ids
+        :param track_col: str | field of the track ids
+        :param album_col: str | field of the album ids
+        :return: pd.DataFrame | indexed as data, with the fields ranking_bucket,
+                 track_tempo and genre
+        """
+        features = pd.DataFrame(index=data.index)
+        features["ranking_bucket"] = self.get_ranking_buckets(data[track_col].values)
+        features["track_tempo"] = self.get_track_tempos(data[track_col].values)
+        features["genre"] = self.get_genres(data[album_col].values)
+        return features
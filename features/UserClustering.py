@@ -0,0 +1,204 @@
+import os
+import json
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix, hstack
+from sklearn.cluster import MiniBatchKMeans
+
+from .History import MembershipIndex, save_npy
+
+
+class UserClustering(object):
+    """
+    Clusters of users with similar tastes
+    Each user is described by a sparse profile of the share of its listens
+    (is_listened == 1) of each artist (and of each genre if the history
+    contains genre_id), clustered with mini-batch k-means. The tracks and
+    artists listened by each cluster are kept in membership indexes
+    """
+
+    def __init__(self, n_clusters=50, batch_size=10000, random_state=0,
+                 path=None):
+        """
+        Constructor of the class
+        :param n_clusters: int | number of clusters
+        :param batch_size: int | number of users per mini-batch of k-means
+        :param random_state: int | seed of k-means
+        :param path: string | directory written by dump, to load an already
+                              fitted instance
+        """
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.vocabulary = dict()
+        self.centers = None
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.tracks = None
+        self.artists = None
+        if path is not None:
+            self.load(path)
+
+    # Fields used to describe the users
+    PROFILE_COLS = ["artist_id", "genre_id"]
+
+    def profiles(self, history):
+        """
+        Get the profile of the users of a history
+        Values (artists, genres) not in self.vocabulary are ignored
+        :param history: History instance
+        :return: scipy.csr_matrix | L2-normalized profiles, one row per user
+                 of history.user_ids
+        """
+        listened = history.columns["is_listened"] == 1
+        rows = history.user_rows()[listened]
+        n_users = len(history.user_ids)
+
+        blocks = []
+        for col, vocabulary in self.vocabulary.items():
+            values = history.columns[col][listened]
+            codes = np.minimum(np.searchsorted(vocabulary, values),
+                               max(len(vocabulary) - 1, 0))
+            known = vocabulary[codes] == values if len(vocabulary) else \
+                np.zeros(len(values), dtype=bool)
+            block = csr_matrix((np.ones(known.sum()),
+                                (rows[known], codes[known])),
+                               shape=(n_users, len(vocabulary)))
+            block.sum_duplicates()
+            # Share of the listens of each user
+            totals = np.asarray(block.sum(axis=1)).ravel()
+            block = csr_matrix(block.multiply(
+                1. / np.maximum(totals, 1)[:, None]))
+            blocks.append(block)
+
+        profiles = hstack(blocks).tocsr()
+        norms = np.sqrt(np.asarray(profiles.multiply(profiles).sum(axis=1)).ravel())
+        return csr_matrix(profiles.multiply(1. / np.maximum(norms, 1e-12)[:, None]))
+
+    def _assign(self, profiles):
+        """
+        Get the closest center of each profile
+        """
+        scores = np.asarray(profiles @ self.centers.T)
+        return np.argmax(2 * scores - (self.centers ** 2).sum(axis=1), axis=1)
+
+    def fit(self, history):
+        """
+        Cluster the users of a history and compute the tracks and artists
+        listened by each cluster
+        :param history: History instance
+        :return: inplace | sets the clusters and the membership indexes
+        """
+        self.vocabulary = {col: np.unique(history.columns[col])
+                           for col in self.PROFILE_COLS if col in history.columns}
+        profiles = self.profiles(history)
+
+        kmeans = MiniBatchKMeans(n_clusters=self.n_clusters,
+                                 batch_size=self.batch_size,
+                                 random_state=self.random_state, n_init=3)
+        kmeans.fit(profiles)
+        self.centers = kmeans.cluster_centers_
+        self.user_ids = np.asarray(history.user_ids)
+        self.labels = self._assign(profiles)
+
+        listened = history.columns["is_listened"] == 1
+        clusters = self.labels[history.user_rows()[listened]]
+        self.tracks = MembershipIndex(clusters, history.columns["media_id"][listened])
+        self.artists = MembershipIndex(clusters, history.columns["artist_id"][listened])
+
+    def predict(self, history):
+        """
+        Get the clusters of (possibly new) users without refitting
+        :param history: History instance | history of the users
+        :return: np.array | cluster of each user of history.user_ids
+        """
+        return self._assign(self.profiles(history))
+
+    def get_clusters(self, user_ids):
+        """
+        :param user_ids: list, array | ids of the users
+        :return: np.array | cluster of each user, -1 if unknown
+        """
+        user_ids = np.asarray(user_ids)
+        if len(self.user_ids) == 0:
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.user_ids, user_ids),
+                          len(self.user_ids) - 1)
+        return np.where(self.user_ids[rows] == user_ids, self.labels[rows], -1)
+
+    def track_was_listened(self, user_ids, track_ids):
+        """
+        :param user_ids: list, array | ids of the users
+        :param track_ids: list, array | ids of tracks, one per user id
+        :return: np.array | True if the track was listened in the user's cluster
+        """
+        return self.tracks.contains(self.get_clusters(user_ids), track_ids)
+
+    def artist_was_listened(self, user_ids, artist_ids):
+        """
+        :param user_ids: list, array | ids of the users
+        :param artist_ids: list, array | ids of artists, one per user id
+        :return: np.array | True if the artist was listened in the user's cluster
+        """
+        return self.artists.contains(self.get_clusters(user_ids), artist_ids)
+
+    def dump(self, path):
+        """
+        Save the instance: centers, vocabulary, clusters of the users and
+        membership indexes as .npy files
+        :param path: string | directory to create
+        :return: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        save_npy(os.path.join(path, "centers.npy"), self.centers)
+        save_npy(os.path.join(path, "user_ids.npy"), self.user_ids)
+        save_npy(os.path.join(path, "labels.npy"), self.labels)
+        for col, vocabulary in self.vocabulary.items():
+            save_npy(os.path.join(path, "vocabulary_%s.npy" % col), vocabulary)
+        self.tracks.dump(path, "tracks")
+        self.artists.dump(path, "artists")
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"vocabulary": list(self.vocabulary)}, f)
+
+    def load(self, path):
+        """
+        Load an instance saved with dump
+        :param path: string | directory written by dump
+        :return: inplace
+        """
+        with open(os.path.join(path, "index.json"), "r") as f:
+            cols = json.load(f)["vocabulary"]
+        self.centers = np.load(os.path.join(path, "centers.npy"))
+        self.n_clusters = len(self.centers)
+        self.user_ids = np.load(os.path.join(path, "user_ids.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+        self.vocabulary = {col: np.load(os.path.join(path, "vocabulary_%s.npy" % col))
+                           for col in cols}
+        self.tracks = MembershipIndex.load(path, "tracks")
+        self.artists = MembershipIndex.load(path, "artists")
+
+    def fingerprint(self):
+        """
+        Get a hash of the clusters, used as a cache key of the features
+        :return: str | hex digest
+        """
+        sha = hashlib.sha1()
+        for values in [self.centers, self.user_ids, self.labels]:
+            sha.update(np.ascontiguousarray(values).tobytes())
+        return sha.hexdigest()
+
+
+if __name__ == "__main__":
+    """
+    Here is how to cluster the users and save the clusters
+    """
+    from .History import History
+
+    hist = History(path="./data/history")
+    clustering = UserClustering(n_clusters=50)
+    clustering.fit(hist)
+    clustering.dump("./data/user_clusters")
+
+    # Scoring does not refit
+    clustering = UserClustering(path="./data/user_clusters")
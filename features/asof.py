@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from .History import count_events, dense_codes
+
+"""
+Point-in-time ("as-of") history features
+Every row is described only with the events strictly before its ts_listen,
+so that the features computed on the training set do not leak the future
+"""
+
+def _occurrences(groups, ts):
+    """
+    Rank (starting at 1) of each event among the events of its group,
+    ordered by ts
+    """
+    order = np.lexsort((ts, groups))
+    sorted_groups = groups[order]
+    occurrences = np.empty(len(groups), dtype=np.int64)
+    occurrences[order] = (np.arange(len(groups)) -
+                          np.searchsorted(sorted_groups, sorted_groups) + 1)
+    return occurrences
+
+def _asof_key_features(event_users, event_values, event_ts,
+                       query_users, query_values, query_ts):
+    """
+    Prior listen count and prior rank of each (user, value) query
+    The rank of a value is 1 + the number of values the user listened to
+    strictly more often before query_ts (ties share the same rank), 0 if the
+    value was never listened to
+    """
+    nb_values, event_values, query_values = dense_codes(event_values,
+                                                         query_values)
+    event_pairs = event_users * nb_values + event_values
+    query_pairs = query_users * nb_values + query_values
+    counts = count_events(event_pairs, event_ts, query_pairs, query_ts)
+
+    # A value has been listened to at least k times before t iff its k-th
+    # listen is before t: counting the k-th listens of the user before t
+    # gives the number of values listened to at least k times
+    occurrences = _occurrences(event_pairs, event_ts)
+    width = len(event_ts) + 2
+    greater = count_events(event_users * width + occurrences, event_ts,
+                           query_users * width + counts + 1, query_ts)
+    ranks = np.where(counts > 0, greater + 1, 0)
+    return counts, ranks
+
+def asof_history_features(data, history=None, n=10):
+    """
+    Computes the history features of every row of data using only the
+    listens (is_listened == 1) strictly before the ts_listen of the row
+    :param data: pd.DataFrame | rows to describe, contains user_id, ts_listen,
+                                media_id and artist_id (and is_listened if
+                                history is None)
+    :param history: History instance | past events, data itself if None
+    :param n: int | size of the top tracks and top artists
+    :return: pd.DataFrame | indexed as data, with for tracks and artists the
+             prior listen count (*_listen_count), whether it was listened
+             before (*_was_previously_listened), the prior rank (*_rank, 0
+             if never listened) and whether it is in the top n (is_top_n_*)
+    """
+    if any(col not in data.columns for col in
+           ["user_id", "ts_listen", "media_id", "artist_id"]):
+        raise IOError("The dataframe must contain the fields: user_id, "
+                      "ts_listen, media_id, artist_id")
+
+    if history is None:
+        listened = data["is_listened"].values == 1
+        events = {col: data[col].values[listened] for col in
+                  ["user_id", "ts_listen", "media_id", "artist_id"]}
+    else:
+        listened = history.columns["is_listened"] == 1
+        events = {col: history.columns[col][listened] for col in
+                  ["ts_listen", "media_id", "artist_id"]}
+        events["user_id"] = history.user_ids[history.user_rows()[listened]]
+
+    _, event_users, query_users = dense_codes(events["user_id"],
+                                               data["user_id"].values)
+    event_ts = events["ts_listen"].astype(np.int64)
+    query_ts = data["ts_listen"].values.astype(np.int64)
+
+    features = pd.DataFrame(index=data.index)
+    for name, key in [("track", "media_id"), ("artist", "artist_id")]:
+        counts, ranks = _asof_key_features(event_users, events[key], event_ts,
+                                           query_users, data[key].values,
+                                           query_ts)
+        features[name + "_listen_count"] = counts
+        features[name + "_was_previously_listened"] = counts > 0
+        features[name + "_rank"] = ranks
+        features["is_top_n_" + name] = (ranks > 0) & (ranks <= n)
+    return features
@@ -2,8 +2,118 @@ import numpy as np
 import pandas as pd
 import json
 
+from preprocessing.preprocessing import decompose_ts
 from .History import date_format
 
+# Windows (in seconds) of the recency counters
+WINDOWS = {
+    "1h": 3600,
+    "6h": 6 * 3600,
+    "24h": 24 * 3600
+}
+
+"""
+Buckets
+Each bucket is defined by its (lower bound, upper bound) and values are
+assigned with np.digitize on the lower bounds: values out of all the buckets
+go to the first or last one
+"""
+# Hours of the day (UTC)
+MOMENTS = {
+    "early_morning": (6, 8),
+    "morning": (9, 12),
+    "day": (13, 17),
+    "evening": (18, 23),
+    "late_night": (0, 5)
+}
+
+# Month of the year % 12
+SEASONS = {
+    "spring": (3, 5),
+    "summer": (6, 8),
+    "autumn": (9, 11),
+    "winter": (0, 2)
+}
+
+# Ages between 18 and 30
+AGE_BUCKETS = {
+    "[18-21]": (18, 21),
+    "[22-25]": (22, 25),
+    "[26-30]": (26, 30)
+}
+
+# Years of release
+DECADES = {
+    "old": (0, 1949),
+    "50s": (1950, 1959),
+    "60s": (1960, 1969),
+    "70s": (1970, 1979),
+    "80s": (1980, 1989),
+    "90s": (1990, 1999),
+    "00s": (2000, 2009),
+    "10s": (2010, 2019),
+}
+
+# Seconds, durations outside of these buckets are considered "medium_duration"
+BUCKET_DURATION = {
+    "very_short_duration": (0, 150),
+    "short_duration": (151, 209),
+    "medium_duration": (210, 299),
+    "long_duration": (300, 10000)
+}
+
+# Levels got by taking a look at the distribution of songs:
+# plt.plot(range(len(tracks['rank'])),np.sort(tracks['rank']))
+# TODO: adjust if necessary
+BUCKET_RANKING = {
+    "not_famous" : (0, 280000),
+    "normal" : (280001, 330000),
+    "quite_famous" : (330001, 530000),
+    "really_famous" : (530001, 1000000)
+}
+
+# Rounded beats per minute
+# TODO: Make sure that the track dataframe does not contain bpm with value 0
+# TODO: adjust to be more specific if needed
+BUCKET_BPM = {
+    "very_slow" : (0, 65),
+    "slow" : (66, 80),
+    "moderate" : (81, 99),
+    "fast" : (100, 120),
+    "very_fast": (121, 1000)
+}
+
+def _bucket_spec(buckets):
+    """
+    Get the labels of buckets sorted by lower bound and the edges to use
+    with np.digitize
+    :param buckets: dict | {label: (lower bound, upper bound)}
+    :return: tuple(list, list) | labels and lower bounds of labels[1:]
+    """
+    labels = sorted(buckets, key=lambda k: buckets[k][0])
+    return labels, [buckets[k][0] for k in labels[1:]]
+
+def _bucket(value, buckets):
+    """
+    Get the bucket of a single value
+    :param value: int, float | value to bucketize
+    :param buckets: dict | {label: (lower bound, upper bound)}
+    :return: string | label of the bucket
+    """
+    labels, edges = _bucket_spec(buckets)
+    return labels[int(np.digitize(value, edges))]
+
+def _bucketize(values, buckets):
+    """
+    Get the buckets of a whole column at once
+    :param values: pd.Series, np.array | values to bucketize
+    :param buckets: dict | {label: (lower bound, upper bound)}
+    :return: pd.Categorical | labels of the buckets
+    """
+    labels, edges = _bucket_spec(buckets)
+    codes = np.digitize(np.asarray(values), edges)
+    return pd.Categorical.from_codes(codes, categories=labels)
+
 """
 General features
 """
@@ -14,22 +124,19 @@ def get_moment_of_day(ts_listen):
     :return: string | element of MOMENTS.keys()
     """
 
-    # Define the moments of the day
-    MOMENTS = {
-        "early_morning": (6, 8),
-        "morning": (9, 12),
-        "day": (12, 17),
-        "evening": (17, 23),
-        "late_night": (0, 5)
-    }
-
     # Get the hour of listening
     hour = date_format(ts_listen)[1].hour
 
-    # Get the corresponding moment
-    moment = [k for (k, v) in MOMENTS.items() if v[0] <= hour <= v[1]][0]
+    return _bucket(hour, MOMENTS)
 
-    return moment
+def get_moment_of_day_batch(ts_listen):
+    """
+    Vectorized version of get_moment_of_day
+    :param ts_listen: pd.Series, np.array | timestamps of listening
+    :return: pd.Categorical | elements of MOMENTS.keys()
+    """
+
+    return _bucketize(decompose_ts(ts_listen)['hour'], MOMENTS)
 
 def get_season(ts_listen):
     """
@@ -38,21 +145,19 @@ def get_season(ts_listen):
     :return: string | element of SEASONS.keys()
     """
 
-    # Define the seasons
-    SEASONS = {
-        "spring": (3, 5),
-        "summer": (6, 8),
-        "autumn": (9, 11),
-        "winter": (0, 2)
-    }
-
     # Get the month of listening
     month = date_format(ts_listen)[1].month % 12
 
-    # Get the corresponding moment
-    season = [k for (k, v) in SEASONS.items() if v[0] <= month <= v[1]][0]
+    return _bucket(month, SEASONS)
+
+def get_season_batch(ts_listen):
+    """
+    Vectorized version of get_season
+    :param ts_listen: pd.Series, np.array | timestamps of listening
+    :return: pd.Categorical | elements of SEASONS.keys()
+    """
 
-    return season
+    return _bucketize(decompose_ts(ts_listen)['month'] % 12, SEASONS)
 
 """
 User features
@@ -64,21 +169,26 @@ def get_user_age_bucket(user_age):
     :return: string | bucket of age
     """
 
-    # Define age buckets: ages between 18 and 30
-    BUCKETS = {
-        "[18-21]" : (18, 21),
-        "[22-25]" : (22, 25),
-        "[26-30]" : (26, 30)
-    }
+    return _bucket(user_age, AGE_BUCKETS)
 
-    # Get user bucket
-    bucket = [k for (k, v) in BUCKETS.items() if v[0] <= user_age <= v[1]][0]
+def get_user_age_bucket_batch(user_age):
+    """
+    Vectorized version of get_user_age_bucket
+    :param user_age: pd.Series, np.array | ages of the users
+    :return: pd.Categorical | buckets of age
+    """
 
-    return bucket
+    return _bucketize(user_age, AGE_BUCKETS)
 
-def get_user_cluster():
-    # TODO: implement
-    pass
+def get_user_cluster(clustering, user_ids):
+    """
+    Get the cluster of users with similar tastes
+    :param clustering: UserClustering instance | fitted clusters of users
+    :param user_ids: list, array | user ids
+    :return: np.array | cluster of each user, -1 if the user is unknown
+    """
+
+    return clustering.get_clusters(user_ids)
 
 def get_user_lang():
     # TODO: implement
@@ -94,17 +204,6 @@ def get_track_age_bucket(track_release_date):
     :return: string | decade of release of the track
     """
 
-    # Buckets defined thanks to :
-    BUCKETS = {
-        "50s" : (1950, 1959),
-        "60s" : (1960, 1969),
-        "70s" : (1970, 1979),
-        "80s" : (1980, 1989),
-        "90s" : (1990, 1999),
-        "00s" : (2000, 2009),
-        "10s" : (2010, 2019),
-    }
-
     # Get release year of song: parse YYYYMMDD
     year = track_release_date // 10000
 
@@ -112,12 +211,20 @@ def get_track_age_bucket(track_release_date):
     # TODO: remove once the data has been cleaned
     if year == 3000:
         return "00s" # teenage years of most users
-    elif year < 1950:
-        return "old"
-    else:
-        # Get bucket
-        bucket = [k for (k, v) in BUCKETS.items() if v[0] <= year <= v[1]][0]
-        return bucket
+
+    return _bucket(year, DECADES)
+
+def get_track_age_bucket_batch(track_release_date):
+    """
+    Vectorized version of get_track_age_bucket
+    :param track_release_date: pd.Series, np.array | format YYYYMMDD : dates of release
+    :return: pd.Categorical | decades of release of the tracks
+    """
+
+    year = np.asarray(track_release_date) // 10000
+    buckets = _bucketize(year, DECADES)
+    buckets[year == 3000] = "00s"
+    return buckets
 
 def is_new_track(track_release_date, ts_listen):
     """
@@ -136,6 +243,17 @@ def is_new_track(track_release_date, ts_listen):
     #TODO: We can add a difference of 1 year to consider it "new"
     return False
 
+def is_new_track_batch(track_release_date, ts_listen):
+    """
+    Vectorized version of is_new_track
+    :param track_release_date: pd.Series, np.array | format YYYYMMDD: dates of release
+    :param ts_listen: pd.Series, np.array | timestamps of listening
+    :return: np.array | boolean array, True if released the year of listening
+    """
+
+    return (np.asarray(track_release_date) // 10000 ==
+            decompose_ts(ts_listen)['year'].values)
+
 def get_track_lang():
     # TODO: to implement
     pass
@@ -144,62 +262,35 @@ def get_ranking_bucket(tracks_df, track_id):
     """
     Get the rank bucket of a track
     The higher the rank, the most famous the song is
+    For a whole column, favour MetadataIndex.get_ranking_buckets
     :param tracks_df: pd.DataFrame | the dataframe of tracks
     :param track_id: int | track id
     :return: string | bucket describing how famous the track is
     """
 
-    # Levels got by taking a look at the distribution of songs:
-    # plt.plot(range(len(tracks['rank'])),np.sort(tracks['rank']))
-    # TODO: adjust if necessary
-    BUCKET_RANKING = {
-        "not_famous" : (0, 280000),
-        "normal" : (280001, 330000),
-        "quite_famous" : (330001, 530000),
-        "really_famous" : (530001, 1000000)
-    }
-
     # Get ranking from tracks dataframe
-    if len(tracks_df[tracks_df['id'] == track_id]['rank'].values) == 0:
+    ranks = tracks_df['rank'].values[tracks_df['id'].values == track_id]
+    if len(ranks) == 0 or np.isnan(ranks[0]):
         return "not_famous"
 
-    rank = tracks_df[tracks_df['id'] == track_id]['rank'].values[0]
-
-    # Get bucket
-    bucket = [k for (k, v) in BUCKET_RANKING.items() if v[0] <= rank <= v[1]][0]
-
-    return bucket
+    return _bucket(ranks[0], BUCKET_RANKING)
 
 def get_track_tempo(tracks_df, track_id):
     """
     Get the tempo of the track as defined by
     https://fr.wikipedia.org/wiki/Battement_par_minute
+    For a whole column, favour MetadataIndex.get_track_tempos
     :param tracks_df: pd.DataFrame | the dataframe of tracks
     :param track_id: int | track id
     :return: string | tempo of the track
     """
 
-    # TODO: Make sure that the track dataframe does not contain bpm with value 0
-    # TODO: adjust to be more specific if needed
-    BUCKET_BPM = {
-        "very_slow" : (0, 65),
-        "slow" : (66, 80),
-        "moderate" : (81, 99),
-        "fast" : (100, 120),
-        "very_fast": (121, 1000)
-    }
-
     # Get bpm from tracks dataframe
-    if len(tracks_df[tracks_df['id'] == track_id]['bpm'].values) == 0:
+    bpms = tracks_df['bpm'].values[tracks_df['id'].values == track_id]
+    if len(bpms) == 0 or np.isnan(bpms[0]):
         return 'Unknown'
 
-    bpm = tracks_df[tracks_df['id'] == track_id]['bpm'].values[0]
-    bpm = round(bpm)
-
-    # Get bucket
-    bucket = [k for (k, v) in BUCKET_BPM.items() if v[0] <= bpm <= v[1]][0]
-
-    return bucket
+    return _bucket(round(bpms[0]), BUCKET_BPM)
 
 def track_was_previously_listened(history, track_id, user_id):
     """
@@ -210,10 +301,18 @@ def track_was_previously_listened(history, track_id, user_id):
     :return: boolean | True if track already listened, else False
     """
 
-    user_history = history.history[user_id]
-    tracks_list = user_history[user_history.is_listened == 1]['media_id'].values
+    return bool(history.contains([user_id], [track_id], "media_id")[0])
 
-    return track_id in tracks_list
+def track_was_previously_listened_batch(history, track_ids, user_ids):
+    """
+    Vectorized version of track_was_previously_listened
+    :param history: History instance | history of all users between two dates
+    :param track_ids: list, array | ids of tracks
+    :param user_ids: list, array | user ids, one per track id
+    :return: np.array | boolean array, True if track already listened
+    """
+
+    return history.contains(user_ids, track_ids, "media_id")
 
 def is_top_n_track(history, user_id, track_id, n=10):
     """
@@ -225,37 +324,80 @@ def is_top_n_track(history, user_id, track_id, n=10):
     :return: boolean | True if track in user's top N tracks, else False
     """
 
-    top_n_tracks = history.get_top_tracks(user_id, n)
-    return track_id in top_n_tracks
+    return bool(history.is_top_n([user_id], [track_id], "media_id", n)[0])
 
-def similar_to_previously_listened_track():
-    # TODO: to implement
-    pass
+def is_top_n_track_batch(history, user_ids, track_ids, n=10):
+    """
+    Vectorized version of is_top_n_track
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param track_ids: list, array | ids of tracks, one per user id
+    :param n: int | number of top tracks
+    :return: np.array | boolean array, True if track in user's top N tracks
+    """
 
-def number_of_similar_tracks_listened_to_in_the_last_hour():
-    # TODO: to implement
-    pass
+    return history.is_top_n(user_ids, track_ids, "media_id", n)
 
-def track_was_listened_by_cluster():
-    # track listened by someone similar to current user
-    # TODO: to implement
-    pass
+def similar_to_previously_listened_track(similarity, history, user_ids,
+                                         track_ids):
+    """
+    Checks how similar a track is to the tracks already listened by the user
+    :param similarity: ItemSimilarity instance | item-item similarity index
+                       (collaborative_filtering/item_similarity.py)
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param track_ids: list, array | ids of tracks, one per user id
+    :return: tuple(np.array, np.array) | max and mean similarity to the tracks
+             listened by the user
+    """
+
+    return similarity.similarity_to_listened(history, user_ids, track_ids)
+
+def number_of_similar_tracks_listened_to_in_the_last_hour(history, user_ids,
+                                                          genre_ids, ts_listen,
+                                                          window=WINDOWS["1h"]):
+    """
+    Counts the tracks of the same genre listened by the user just before
+    The history must have been fitted on data containing genre_id
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param genre_ids: list, array | genre of the tracks, one per user id
+    :param ts_listen: list, array | timestamps of listening, one per user id
+    :param window: int, list | window in seconds (or list of windows) before
+                               ts_listen, see WINDOWS
+    :return: np.array | number of tracks of the same genre listened in the window
+    """
+
+    return history.count_in_window(user_ids, genre_ids, ts_listen, window,
+                                   "genre_id")
+
+def track_was_listened_by_cluster(clustering, user_ids, track_ids):
+    """
+    Checks whether a track was listened by someone similar to the user
+    :param clustering: UserClustering instance | fitted clusters of users
+    :param user_ids: list, array | user ids
+    :param track_ids: list, array | ids of tracks, one per user id
+    :return: np.array | boolean array, True if the track was listened in the
+             user's cluster
+    """
+
+    return clustering.track_was_listened(user_ids, track_ids)
 
 def get_genre(album_genres_df, album_id):
     """
     Get the genre of album (by extension that of the song)
     Up to 45 genres
+    For a whole column, favour MetadataIndex.get_genres
     :param album_genres_df: pd.DataFrame | dataframe mapping each album to a genre
     :param album_id: int | album id
     :return: string | track genre
     """
-    # Some checks
-    if album_id not in album_genres_df.album_id:
-        return 'Unknown'
-    if len(album_genres_df[album_genres_df.album_id == album_id].new_genre_name.values) == 0:
+    genres = album_genres_df.new_genre_name.values[
+        album_genres_df.album_id.values == album_id]
+    if len(genres) == 0:
         return 'Unknown'
 
-    return album_genres_df[album_genres_df.album_id == album_id].new_genre_name.values[0]
+    return genres[0]
 
 
 def get_media_duration_bucket(media_duration):
@@ -264,25 +406,31 @@ def get_media_duration_bucket(media_duration):
 
     Parameters
     ----------
-    df: pd.DataFrame | contains a column media_duration
+    media_duration: int, float | duration of the track in seconds
     """
 
-    BUCKET_DURATION = {
-        "very_short_duration": (0, 150),
-        "short_duration": (151, 209),
-        "medium_duration": (210, 299),
-        "long_duration": (300, 10000)
-    }
-
     media_duration = round(media_duration)
 
-    # Get bucket
-    if len([k for (k, v) in BUCKET_DURATION.items() if v[0] <= media_duration <= v[1]]) == 0:
+    # Outliers are considered as medium
+    if not 0 <= media_duration <= 10000:
         return "medium_duration"
 
-    bucket = [k for (k, v) in BUCKET_DURATION.items() if v[0] <= media_duration <= v[1]][0]
+    return _bucket(media_duration, BUCKET_DURATION)
 
-    return bucket
+def get_media_duration_bucket_batch(media_duration):
+    """
+    Vectorized version of get_media_duration_bucket
+
+    Parameters
+    ----------
+    media_duration: pd.Series, np.array | durations of the tracks in seconds
+    """
+
+    media_duration = np.round(np.asarray(media_duration, dtype=float))
+    buckets = _bucketize(media_duration, BUCKET_DURATION)
+    outliers = ~((media_duration >= 0) & (media_duration <= 10000))
+    buckets[outliers] = "medium_duration"
+    return buckets
 
 """
 Artist features
@@ -297,15 +445,30 @@ def artist_was_previously_listened(history, user_id, artist_id):
     :return: boolean | True if track already listened, else False
     """
 
-    user_history = history.history[user_id]
-    artists = user_history[user_history.is_listened == 1]['artist_id'].values
+    return bool(history.contains([user_id], [artist_id], "artist_id")[0])
+
+def artist_was_previously_listened_batch(history, user_ids, artist_ids):
+    """
+    Vectorized version of artist_was_previously_listened
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param artist_ids: list, array | ids of artists, one per user id
+    :return: np.array | boolean array, True if artist already listened
+    """
 
-    return artist_id in artists
+    return history.contains(user_ids, artist_ids, "artist_id")
 
-def artist_was_listened_by_cluster():
-    # track listened by someone similar to current user
-    # TODO: to implement
-    pass
+def artist_was_listened_by_cluster(clustering, user_ids, artist_ids):
+    """
+    Checks whether an artist was listened by someone similar to the user
+    :param clustering: UserClustering instance | fitted clusters of users
+    :param user_ids: list, array | user ids
+    :param artist_ids: list, array | ids of artists, one per user id
+    :return: np.array | boolean array, True if the artist was listened in the
+             user's cluster
+    """
+
+    return clustering.artist_was_listened(user_ids, artist_ids)
 
 def is_top_n_artist(history, user_id, artist_id, n=10):
     """
@@ -317,9 +480,33 @@ def is_top_n_artist(history, user_id, artist_id, n=10):
     :return: boolean | True if artist in user's top N artists, else False
     """
 
-    top_n_artists = history.get_top_artists(user_id, n)
-    return artist_id in top_n_artists
+    return bool(history.is_top_n([user_id], [artist_id], "artist_id", n)[0])
 
-def number_of_times_listened_to_artist_in_last_hour():
-    # TODO: to implement
-    pass
+def is_top_n_artist_batch(history, user_ids, artist_ids, n=10):
+    """
+    Vectorized version of is_top_n_artist
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param artist_ids: list, array | ids of artists, one per user id
+    :param n: int | number of top artists
+    :return: np.array | boolean array, True if artist in user's top N artists
+    """
+
+    return history.is_top_n(user_ids, artist_ids, "artist_id", n)
+
+def number_of_times_listened_to_artist_in_last_hour(history, user_ids,
+                                                    artist_ids, ts_listen,
+                                                    window=WINDOWS["1h"]):
+    """
+    Counts the listens of the artist by the user just before
+    :param history: History instance | history of all users between two dates
+    :param user_ids: list, array | user ids
+    :param artist_ids: list, array | ids of artists, one per user id
+    :param ts_listen: list, array | timestamps of listening, one per user id
+    :param window: int, list | window in seconds (or list of windows) before
+                               ts_listen, see WINDOWS
+    :return: np.array | number of listens of the artist in the window
+    """
+
+    return history.count_in_window(user_ids, artist_ids, ts_listen, window,
+                                   "artist_id")
@@ -0,0 +1,446 @@
+import os
+import json
+import hashlib
+import inspect
+import types
+import numpy as np
+import pandas as pd
+
+from . import features as F
+
+"""
+Declarative feature pipeline
+Each feature declares the columns it reads and the resources it requires (a
+fitted History, a MetadataIndex, ...). A FeaturePipeline computes the
+requested features of a dataframe and caches every result column on disk,
+keyed by a fingerprint of its inputs and of its code: re-running an
+experiment only computes the features that changed.
+"""
+
+class Feature(object):
+    def __init__(self, name, func, inputs, requires=(), version=0, output=None):
+        """
+        Constructor of the class
+        :param name: str | name of the feature (and of the result column)
+        :param func: function | called with the input columns (pd.Series) as
+                                positional arguments and the required resources
+                                as keyword arguments, returns one value per row
+        :param inputs: list | columns of the dataframe (or names of other
+                              features) read by the feature
+        :param requires: list | names of the resources used by the feature
+        :param version: int | bump it to invalidate the cached values when a
+                              change isn't seen by the fingerprint (ex: code
+                              outside of this repository)
+        :param output: tuple | (group, i) if func returns several columns
+                               (computed once per transform) and the feature
+                               is the i-th one, None otherwise
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.requires = list(requires)
+        self.version = version
+        self.output = output
+
+
+# Registry of the features available to the pipelines {name: Feature}
+FEATURES = dict()
+
+def register(name, inputs, requires=(), registry=None, version=0, outputs=None):
+    """
+    Decorator adding a function to a registry of features
+    :param name: str | name of the feature
+    :param inputs: list | columns read by the feature
+    :param requires: list | names of the resources used by the feature
+    :param registry: dict | registry to update, FEATURES if None
+    :param version: int | version of the feature, see Feature
+    :param outputs: list | names of the features if the function returns a
+                           tuple of columns, registered instead of name
+    :return: function | the decorated function, unchanged
+    """
+    registry = FEATURES if registry is None else registry
+
+    def decorator(func):
+        if outputs is None:
+            registry[name] = Feature(name, func, inputs, requires, version)
+        for i, output in enumerate(outputs or []):
+            registry[output] = Feature(output, func, inputs, requires, version,
+                                       output=(name, i))
+        return func
+    return decorator
+
+#########################
+#     Fingerprints      #
+#########################
+
+# Root of the repository: the modules under it are part of the fingerprints
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _is_local(module):
+    path = getattr(module, "__file__", None)
+    return path is not None and os.path.abspath(path).startswith(ROOT + os.sep)
+
+def _local_modules(modules):
+    """
+    Modules of the repository used by some modules: the modules themselves and,
+    recursively, the modules they import or import objects from
+    """
+    found, stack = dict(), [m for m in modules if _is_local(m)]
+    while stack:
+        module = stack.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        for value in vars(module).values():
+            if not isinstance(value, types.ModuleType):
+                value = inspect.getmodule(value) if (
+                    inspect.isfunction(value) or inspect.isclass(value)) else None
+            if value is not None and _is_local(value) and value.__name__ not in found:
+                stack.append(value)
+    return [found[name] for name in sorted(found)]
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj).encode("utf-8")
+    except (IOError, TypeError):
+        return obj.__code__.co_code if hasattr(obj, "__code__") else repr(obj).encode("utf-8")
+
+def _module_source(module):
+    """
+    Source of a module and current values of its constants (ex: MOMENTS)
+    """
+    constants = sorted((name, repr(value)) for name, value in vars(module).items()
+                       if not name.startswith("__")
+                       and isinstance(value, (int, float, str, tuple, list, dict)))
+    return _source(module) + repr(constants).encode("utf-8")
+
+def _code_fingerprint(func):
+    """
+    Hash of the source code of a function, of the functions and values it
+    uses directly from its module, and of the whole source of the modules it
+    uses (ex: F, with its bucket constants and helpers) and of their own
+    dependencies in the repository
+    """
+    names = func.__code__.co_names
+    scope = func.__globals__
+    modules = [scope[name] for name in names
+               if isinstance(scope.get(name), types.ModuleType)]
+    modules += [inspect.getmodule(scope[name]) for name in names
+                if name in scope and not isinstance(scope[name], types.ModuleType)
+                and inspect.getmodule(scope[name]) not in (None, inspect.getmodule(func))]
+
+    sha = hashlib.sha1(_source(func))
+    for name in names:
+        value = scope.get(name)
+        if isinstance(value, types.FunctionType):
+            sha.update(_source(value))
+        elif isinstance(value, (int, float, str, tuple, list, dict)):
+            sha.update(repr(value).encode("utf-8"))
+    for module in _local_modules([m for m in modules if m is not None]):
+        sha.update(_module_source(module))
+    return sha.hexdigest()
+
+def _resource_fingerprint(resource):
+    """
+    Hash of a resource: its fingerprint() and the source of the modules of its
+    class (ex: History.py for the History methods used by the features)
+    """
+    sha = hashlib.sha1(resource.fingerprint().encode("utf-8"))
+    for module in _local_modules([inspect.getmodule(type(resource))]):
+        sha.update(_module_source(module))
+    return sha.hexdigest()
+
+def _column_fingerprint(column):
+    """
+    Hash of the values of a column
+    """
+    sha = hashlib.sha1(str(column.dtype).encode("utf-8"))
+    if isinstance(column.dtype, np.dtype) and column.dtype.kind in "biufcmM":
+        values = np.ascontiguousarray(column.values)
+    else:
+        # Object, string, categorical... values are hashed by content
+        values = pd.util.hash_pandas_object(column, index=False).values
+    sha.update(values.tobytes())
+    return sha.hexdigest()
+
+#########################
+#     Pipeline Class    #
+#########################
+
+class FeaturePipeline(object):
+    def __init__(self, cache_dir=None, registry=None, **resources):
+        """
+        Constructor of the class
+        :param cache_dir: str | directory of the cached features, no cache if None
+        :param registry: dict | {name: Feature}, FEATURES if None
+        :param resources: objects used by the features (history=History
+                          instance, metadata=MetadataIndex instance, ...).
+                          Features using a resource without a fingerprint()
+                          method are never cached
+        """
+        self.cache_dir = cache_dir
+        self.registry = FEATURES if registry is None else registry
+        self.resources = resources
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _fingerprint(self, name, data, fingerprints):
+        """
+        Fingerprint of a feature computed on data, None if it can't be cached
+        """
+        if name in fingerprints:
+            return fingerprints[name]
+
+        feature = self.registry[name]
+        sha = hashlib.sha1(("%s:%s" % (name, feature.version)).encode("utf-8"))
+        sha.update(_code_fingerprint(feature.func).encode("utf-8"))
+        fingerprints[name] = None
+        for col in feature.inputs:
+            if col in data.columns:
+                sha.update(_column_fingerprint(data[col]).encode("utf-8"))
+            else:
+                dependency = self._fingerprint(col, data, fingerprints)
+                if dependency is None:
+                    return None
+                sha.update(dependency.encode("utf-8"))
+        for res in feature.requires:
+            if not hasattr(self.resources[res], "fingerprint"):
+                return None
+            # Resources are hashed once per transform
+            if "@" + res not in fingerprints:
+                fingerprints["@" + res] = _resource_fingerprint(self.resources[res])
+            sha.update(fingerprints["@" + res].encode("utf-8"))
+
+        fingerprints[name] = sha.hexdigest()
+        return fingerprints[name]
+
+    def _missing_resources(self, name, data):
+        """
+        Resources required by a feature, or by the features it reads, that
+        were not given to the pipeline
+        """
+        missing, todo, seen = set(), [name], {name}
+        while todo:
+            feature = self.registry[todo.pop()]
+            missing.update(res for res in feature.requires
+                           if res not in self.resources)
+            for col in feature.inputs:
+                if col not in data.columns and col in self.registry and \
+                        col not in seen:
+                    seen.add(col)
+                    todo.append(col)
+        return sorted(missing)
+
+    def _cache_path(self, name, fingerprint):
+        return os.path.join(self.cache_dir, "%s-%s" % (name, fingerprint))
+
+    def _load(self, name, fingerprint):
+        """
+        Load a cached column, None if not cached
+        """
+        if self.cache_dir is None or fingerprint is None:
+            return None
+        path = self._cache_path(name, fingerprint)
+        if not os.path.exists(path + ".json"):
+            return None
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+        values = np.load(path + ".npy")
+        if meta["categories"] is not None:
+            return pd.Categorical.from_codes(values, categories=meta["categories"])
+        return values
+
+    def _save(self, name, fingerprint, values):
+        """
+        Cache a column: one .npy file (codes for categorical values) and a
+        .json file with the categories
+        """
+        if self.cache_dir is None or fingerprint is None:
+            return
+        path = self._cache_path(name, fingerprint)
+        categories = None
+        if isinstance(values, pd.Categorical):
+            categories = values.categories.tolist()
+            values = values.codes
+        np.save(path + ".npy", values)
+        with open(path + ".json", "w") as f:
+            json.dump({"categories": categories}, f)
+
+    def _compute(self, name, data, results, fingerprints):
+        """
+        Compute (or load from the cache) a feature and its dependencies
+        """
+        if name in results:
+            return results[name]
+        if name not in self.registry:
+            raise KeyError("Unknown feature %s" % name)
+
+        feature = self.registry[name]
+        fingerprint = self._fingerprint(name, data, fingerprints)
+        values = self._load(name, fingerprint)
+        if values is None:
+            args = [data[col] if col in data.columns else
+                    pd.Series(self._compute(col, data, results, fingerprints),
+                              index=data.index)
+                    for col in feature.inputs]
+            kwargs = {res: self.resources[res] for res in feature.requires}
+            if feature.output is None:
+                values = feature.func(*args, **kwargs)
+            else:
+                # The columns of a group are computed once per transform
+                group = "#" + feature.output[0]
+                if group not in results:
+                    results[group] = feature.func(*args, **kwargs)
+                values = results[group][feature.output[1]]
+            if isinstance(values, pd.Series):
+                values = values.values
+            if not isinstance(values, pd.Categorical):
+                values = np.asarray(values)
+                if values.dtype == object:
+                    values = pd.Categorical(values)
+            self._save(name, fingerprint, values)
+        results[name] = values
+        return values
+
+    def transform(self, data, names=None):
+        """
+        Compute features on a dataframe
+        :param data: pd.DataFrame | data containing the inputs of the features
+        :param names: list | names of the features, all the registered
+                             features whose resources were given if None
+        :return: pd.DataFrame | indexed as data, one column per feature
+        """
+        if names is None:
+            names = [name for name in self.registry
+                     if not self._missing_resources(name, data)]
+        for name in names:
+            if name not in self.registry:
+                raise KeyError("Unknown feature %s" % name)
+            missing = self._missing_resources(name, data)
+            if missing:
+                raise IOError("Feature %s requires the resources %s: pass them "
+                              "to FeaturePipeline (ex: FeaturePipeline(%s=...))"
+                              % (name, ", ".join(missing), missing[0]))
+        results, fingerprints = dict(), dict()
+        features = pd.DataFrame(index=data.index)
+        for name in names:
+            features[name] = self._compute(name, data, results, fingerprints)
+        return features
+
+#########################
+#   Registered features #
+#########################
+
+@register("moment_of_day", ["ts_listen"])
+def moment_of_day(ts_listen):
+    return F.get_moment_of_day_batch(ts_listen)
+
+@register("season", ["ts_listen"])
+def season(ts_listen):
+    return F.get_season_batch(ts_listen)
+
+@register("user_age_bucket", ["user_age"])
+def user_age_bucket(user_age):
+    return F.get_user_age_bucket_batch(user_age)
+
+@register("track_age_bucket", ["release_date"])
+def track_age_bucket(release_date):
+    return F.get_track_age_bucket_batch(release_date)
+
+@register("is_new_track", ["release_date", "ts_listen"])
+def is_new_track(release_date, ts_listen):
+    return F.is_new_track_batch(release_date, ts_listen)
+
+@register("media_duration_bucket", ["media_duration"])
+def media_duration_bucket(media_duration):
+    return F.get_media_duration_bucket_batch(media_duration)
+
+@register("ranking_bucket", ["media_id"], requires=["metadata"])
+def ranking_bucket(media_id, metadata):
+    return metadata.get_ranking_buckets(media_id.values)
+
+@register("track_tempo", ["media_id"], requires=["metadata"])
+def track_tempo(media_id, metadata):
+    return metadata.get_track_tempos(media_id.values)
+
+@register("genre", ["album_id"], requires=["metadata"])
+def genre(album_id, metadata):
+    return metadata.get_genres(album_id.values)
+
+@register("track_was_previously_listened", ["user_id", "media_id"],
+          requires=["history"])
+def track_was_previously_listened(user_id, media_id, history):
+    return F.track_was_previously_listened_batch(history, media_id.values,
+                                                 user_id.values)
+
+@register("artist_was_previously_listened", ["user_id", "artist_id"],
+          requires=["history"])
+def artist_was_previously_listened(user_id, artist_id, history):
+    return F.artist_was_previously_listened_batch(history, user_id.values,
+                                                  artist_id.values)
+
+@register("is_top_n_track", ["user_id", "media_id"], requires=["history"])
+def is_top_n_track(user_id, media_id, history):
+    return F.is_top_n_track_batch(history, user_id.values, media_id.values)
+
+@register("is_top_n_artist", ["user_id", "artist_id"], requires=["history"])
+def is_top_n_artist(user_id, artist_id, history):
+    return F.is_top_n_artist_batch(history, user_id.values, artist_id.values)
+
+@register("artist_listens_last_hour", ["user_id", "artist_id", "ts_listen"],
+          requires=["history"])
+def artist_listens_last_hour(user_id, artist_id, ts_listen, history):
+    return F.number_of_times_listened_to_artist_in_last_hour(
+        history, user_id.values, artist_id.values, ts_listen.values)
+
+@register("similar_tracks_listens_last_hour",
+          ["user_id", "genre_id", "ts_listen"], requires=["history"])
+def similar_tracks_listens_last_hour(user_id, genre_id, ts_listen, history):
+    return F.number_of_similar_tracks_listened_to_in_the_last_hour(
+        history, user_id.values, genre_id.values, ts_listen.values)
+
+@register("similarity_to_listened", ["user_id", "media_id"],
+          requires=["history", "similarity"],
+          outputs=["max_similarity_to_listened", "mean_similarity_to_listened"])
+def similarity_to_listened(user_id, media_id, history, similarity):
+    return F.similar_to_previously_listened_track(
+        similarity, history, user_id.values, media_id.values)
+
+
+@register("user_cluster", ["user_id"], requires=["clustering"])
+def user_cluster(user_id, clustering):
+    return F.get_user_cluster(clustering, user_id.values)
+
+@register("track_was_listened_by_cluster", ["user_id", "media_id"],
+          requires=["clustering"])
+def track_was_listened_by_cluster(user_id, media_id, clustering):
+    return F.track_was_listened_by_cluster(clustering, user_id.values,
+                                           media_id.values)
+
+@register("artist_was_listened_by_cluster", ["user_id", "artist_id"],
+          requires=["clustering"])
+def artist_was_listened_by_cluster(user_id, artist_id, clustering):
+    return F.artist_was_listened_by_cluster(clustering, user_id.values,
+                                            artist_id.values)
+
+
+if __name__ == "__main__":
+    """
+    Here is how to compute (and cache) features for an experiment
+    """
+    from .History import History
+    from .MetadataIndex import MetadataIndex
+
+    train = pd.read_csv("./data/train.csv")
+    hist = History(path="./data/history")
+    meta = MetadataIndex(tracks_df=pd.read_csv("./data/tracks.csv"),
+                         album_genres_df=pd.read_csv("./data/album_genres.csv"))
+
+    pipeline = FeaturePipeline(cache_dir="./data/features_cache",
+                               history=hist, metadata=meta)
+    X = pipeline.transform(train, ["moment_of_day", "season", "genre",
+                                   "is_top_n_track"])
+
+    # Adding a feature only computes the new one, the others are read from the cache
+    X = pipeline.transform(train, ["moment_of_day", "season", "genre",
+                                   "is_top_n_track", "artist_listens_last_hour"])
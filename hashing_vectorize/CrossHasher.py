@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+from multiprocess import Pool
+from scipy.sparse import csr_matrix
+
+from .Hasher import Hasher, MAX_SIZE, to_keys, mix64, murmurhash3_32
+
+
+def _hash_chunk(args):
+    """
+    Intermediary function used for multiprocessing
+    Hashes a chunk with the parameters of a CrossHasher, see hash_chunk
+    """
+    chunk, columns, crosses, size, seed, signed, symbol = args
+    return CrossHasher(columns, crosses, size, seed, signed,
+                       symbol=symbol).hash_chunk(chunk)
+
+
+class CrossHasher(Hasher):
+    """
+    Hashes base features and crosses of features into one sparse matrix
+    The crosses are never added to the dataframe: the keys of the values of
+    each cross are combined (mix64) and hashed directly, chunk by chunk
+    """
+
+    def __init__(self, columns=None, crosses=(), size=MAX_SIZE, seed=0,
+                 signed=False, chunksize=1000000, symbol='&',
+                 max_collision_rate=0.01):
+        """
+        Constructor
+        :param columns: list | base features to hash, all the columns of the
+                               data if None
+        :param crosses: list | crosses to hash, tuples of 2 or more column
+                               names, ex: [('user_age', 'genre_id'),
+                               ('user_gender', 'genre_id', 'artist_id')]
+        :param size: int | size of each sparse vector, chosen by fit
+                           (recommend_size, crosses included) if None
+        :param seed: int | seed of the hash function
+        :param signed: bool | if True, active values are +1/-1 (see Hasher)
+        :param chunksize: int | number of rows hashed at once
+        :param symbol: str | symbol joining the names of crossed columns
+        :param max_collision_rate: float | target collision rate when size is
+                                           chosen by fit
+        """
+        Hasher.__init__(self, size=size, seed=seed, signed=signed,
+                        max_collision_rate=max_collision_rate)
+        self.columns = columns
+        self.crosses = [tuple(cross) for cross in crosses]
+        self.chunksize = chunksize
+        self.symbol = symbol
+        for cross in self.crosses:
+            if len(cross) < 2:
+                raise IOError("A cross needs at least 2 columns: %s" % (cross,))
+
+    def feature_names(self, data):
+        """
+        :param data: pd.DataFrame | data to hash
+        :return: list | names of the hashed features, base features first
+        """
+        columns = list(data.columns) if self.columns is None else list(self.columns)
+        return columns + [self.symbol.join(cross) for cross in self.crosses]
+
+    def feature_keys(self, chunk):
+        """
+        Keys of the base features and of the crosses of a chunk of rows
+        The keys of each column are computed once and shared by its crosses
+        :param chunk: pd.DataFrame | rows to hash
+        :return: list | (name, np.array of uint64 keys) of each feature
+        """
+        columns = list(chunk.columns) if self.columns is None else list(self.columns)
+        keys = dict()
+
+        def _keys(col):
+            if col not in keys:
+                keys[col] = to_keys(chunk[col].values)
+            return keys[col]
+
+        features = [(col, _keys(col)) for col in columns]
+        for cross in self.crosses:
+            crossed = _keys(cross[0])
+            for col in cross[1:]:
+                crossed = mix64(crossed, _keys(col))
+            features.append((self.symbol.join(cross), crossed))
+        return features
+
+    def hash_chunk(self, chunk):
+        """
+        Hashes the base features and the crosses of a chunk of rows
+        :param chunk: pd.DataFrame | rows to hash
+        :return: 2-tuple | (n_rows, n_features) arrays of the positions of the
+                           active features and of their values
+        """
+        features = self.feature_keys(chunk)
+        positions = np.empty((len(chunk), len(features)), dtype=np.int64)
+        values = np.ones((len(chunk), len(features)))
+        for j, (name, feature_keys) in enumerate(features):
+            hashed = murmurhash3_32(feature_keys, self.column_seed(name))
+            positions[:, j] = hashed % self.size
+            if self.signed:
+                values[:, j] = np.where(hashed >> np.uint32(31), -1., 1.)
+        return positions, values
+
+    def distinct_values(self, data):
+        """
+        Distinct keys of each base feature and cross, used by collisions and
+        recommend_size (the keys hash like the values they stand for)
+        :param data: pd.DataFrame | data to hash
+        :return: dict | {feature name: np.array of distinct uint64 keys}
+        """
+        return dict((name, np.unique(feature_keys))
+                    for name, feature_keys in self.feature_keys(data))
+
+    def transform(self, data, cores=1):
+        """
+        Creates a sparse matrix from data, with the base features and crosses
+        data MUST NOT contain the labels (unless columns excludes them)
+        :param data: pd.DataFrame | dataframe to sparsify
+        :param cores: int | number of processes hashing the chunks
+        :return: scipy.csr_matrix | sparse matrix of shape (data.shape[0], self.size)
+        """
+        required = set(self.columns or []) | set(
+            col for cross in self.crosses for col in cross)
+        missing = required - set(data.columns)
+        if missing:
+            raise IOError("%s must be columns of your dataframe" % sorted(missing))
+
+        chunks = [data.iloc[start:start + self.chunksize]
+                  for start in range(0, len(data), self.chunksize)]
+        if cores > 1 and len(chunks) > 1:
+            # Only the chunk and the parameters are sent, not self (and self.data)
+            params = (self.columns, self.crosses, self.size, self.seed,
+                      self.signed, self.symbol)
+            with Pool(cores) as p:
+                hashed = p.map(_hash_chunk, [(chunk,) + params for chunk in chunks])
+        else:
+            hashed = list(map(self.hash_chunk, chunks))
+
+        n_features = len(self.feature_names(data))
+        if hashed:
+            indices = np.concatenate([h[0].ravel() for h in hashed])
+            values = np.concatenate([h[1].ravel() for h in hashed])
+        else:
+            indices, values = np.empty(0, dtype=np.int64), np.empty(0)
+        indptr = np.arange(len(data) + 1, dtype=np.int64) * n_features
+        sparse_matrix = csr_matrix((values, indices, indptr),
+                                   shape=(len(data), self.size))
+        sparse_matrix.sum_duplicates()
+        if self.signed:
+            sparse_matrix.eliminate_zeros()
+        return sparse_matrix
+
+
+if __name__ == "__main__":
+    """
+    Here is how to hash base features and their crosses in one pass
+    """
+
+    # Load your data
+    data = pd.read_csv("./data/train.csv")
+    labels = data.pop("is_listened")
+
+    # Crosses of 2 or more features, never added to data
+    crosses = [('user_age', 'genre_id'),
+               ('user_gender', 'artist_id'),
+               ('user_gender', 'user_age', 'genre_id')]
+
+    hash = CrossHasher(crosses=crosses, size=2 ** 22)
+    data_sparse = hash.fit_transform(data)
+
+    # Too big to fit in memory: hash by chunks to the disk (see Hasher)
+    hash.transform_to_disk("./data/train.csv", "./data/train_hashed",
+                           label="is_listened")
@@ -1,95 +1,432 @@
+import os
+import json
 import numpy as np
 import pandas as pd
 from multiprocess import Pool
 from scipy.sparse import csr_matrix
+from hashlib import blake2b
 import sys
 
 MAX_SIZE = 1000000  # sys.maxsize throws an error when transforming the data
 
+# Constants of MurmurHash3 (x86, 32 bits)
+_C1, _C2 = np.uint32(0xcc9e2d51), np.uint32(0x1b873593)
+_M1, _M2 = np.uint32(0x85ebca6b), np.uint32(0xc2b2ae35)
+
+_NAN_KEY = np.array([np.nan]).view(np.uint64)[0]
+
+
+def _rotl(x, r):
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def murmurhash3_32(keys, seed=0):
+    """
+    Vectorized MurmurHash3 (x86, 32 bits) of 8-byte keys
+    Gives the same values as MurmurHash3 applied to the little-endian bytes
+    of each key, whatever the process (unlike the built-in hash function)
+    :param keys: np.array | uint64 keys
+    :param seed: int | seed of the hash function
+    :return: np.array | uint32 hash-values
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    h = np.full(keys.shape, seed & 0xffffffff, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for block in [keys & np.uint64(0xffffffff), keys >> np.uint64(32)]:
+            k = block.astype(np.uint32) * _C1
+            k = _rotl(k, 15) * _C2
+            h = _rotl(h ^ k, 13) * np.uint32(5) + np.uint32(0xe6546b64)
+        h ^= np.uint32(8)
+        h ^= h >> np.uint32(16)
+        h *= _M1
+        h ^= h >> np.uint32(13)
+        h *= _M2
+        h ^= h >> np.uint32(16)
+    return h
+
+
+def _float_keys(values):
+    """
+    Keys of float values: integral values have the key of the same integer
+    (7.0 and 7 are the same value), the others their bits
+    """
+    values = np.asarray(values, dtype=np.float64) + 0.  # -0. is hashed as 0.
+    keys = values.view(np.uint64).copy()
+    integral = (values == np.trunc(values)) & (np.abs(values) < 2. ** 63)
+    keys[integral] = values[integral].astype(np.int64).view(np.uint64)
+    keys[np.isnan(values)] = _NAN_KEY
+    return keys
+
+
+def to_keys(values):
+    """
+    Converts values to uint64 keys to hash
+    Integers (and booleans) are used as is, integral floats as the same
+    integer (an int column upcast to float because of a NaN keeps its keys),
+    other floats by their bits and any other value by the 8-byte blake2b
+    digest of its string. Missing values have the key of a float NaN,
+    whatever the type of the column
+    :param values: pd.Series, array | values of a column
+    :return: np.array | uint64 key of each value
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "biu":
+        return values.astype(np.int64).view(np.uint64)
+    if values.dtype.kind == "f":
+        return _float_keys(values)
+
+    # Each distinct value is digested once
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    keys = np.array([int.from_bytes(blake2b(str(x).encode("utf-8"),
+                                            digest_size=8).digest(), "little")
+                     for x in uniques], dtype=np.uint64)
+    # Numbers stored in an object column have the keys of a numeric column
+    numeric = np.array([isinstance(x, (int, float, np.integer, np.floating))
+                        and not isinstance(x, (bool, np.bool_)) for x in uniques],
+                       dtype=bool)
+    if numeric.any():
+        keys[numeric] = _float_keys([float(x) for x in np.asarray(uniques)[numeric]])
+    keys[np.asarray(pd.isna(uniques), dtype=bool)] = _NAN_KEY
+    return keys[codes]
+
+
+def mix64(keys_1, keys_2):
+    """
+    Vectorized combination of two uint64 keys into one (splitmix64 finalizer)
+    Used to hash crosses of features: mix64(a, b) != mix64(b, a)
+    :param keys_1: np.array | uint64 keys
+    :param keys_2: np.array | uint64 keys
+    :return: np.array | uint64 keys
+    """
+    with np.errstate(over="ignore"):
+        z = np.asarray(keys_1, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15)
+        z ^= np.asarray(keys_2, dtype=np.uint64)
+        z ^= z >> np.uint64(30)
+        z *= np.uint64(0xbf58476d1ce4e5b9)
+        z ^= z >> np.uint64(27)
+        z *= np.uint64(0x94d049bb133111eb)
+        z ^= z >> np.uint64(31)
+    return z
+
+
+def _hash_column(args):
+    """
+    Intermediary function used for multiprocessing
+    Hashes a column with the parameters of a Hasher, see Hasher.hash_column
+    """
+    values, name, size, hash, seed, signed = args
+    return Hasher(size=size, hash=hash, seed=seed,
+                  signed=signed).hash_column(values, name)
+
 
 class Hasher():
-    def __init__(self, data=None, size=MAX_SIZE, hash=None):
+    def __init__(self, data=None, size=MAX_SIZE, hash=None, seed=0,
+                 signed=False, max_collision_rate=0.01):
         """
         Constructor
         :param data: pd.DataFrame | dataframe to sparsify
-        :param size: int | size of each sparse vector
-        :param hash : function | hash function (optional)
+        :param size: int | size of each sparse vector, chosen by fit
+                           (recommend_size) if None
+        :param hash : function | hash function applied to str(value) (optional),
+                                 MurmurHash3 namespaced by column if None
+        :param seed: int | seed of the default hash function
+        :param signed: bool | if True, active values are +1/-1 depending on a
+                              bit of the hash so that collisions cancel out
+                              on average instead of adding up
+        :param max_collision_rate: float | target collision rate when size is
+                                           chosen by fit
         """
         self.data = data
         self.size = size
         self.hash = hash
+        self.seed = seed
+        self.signed = signed
+        self.max_collision_rate = max_collision_rate
 
     def fit(self, data):
         """
         Fit the instance to data
         :param data: pd.DataFrame | data to fit
-        :return: None | set self.data
+        :return: None | set self.data (and self.size if it is None)
         """
         self.data = data
+        if self.size is None:
+            self.size = self.recommend_size(data, self.max_collision_rate)
 
-    def hash_row(self, row):
+    def column_seed(self, name):
+        """
+        Seed used to hash the values of a column
+        The same value in two columns is hashed differently, no need to
+        concatenate "feature_name" and value
+        :param name: str | name of the column
+        :return: int | seed
+        """
+        return int(murmurhash3_32(to_keys([str(name)]), self.seed)[0])
+
+    def hash_row(self, row, names=None):
         """
         Hashes the values of row mapping it to integers
-        Those values will be used as the positions of active features (all set at 1.0)
+        Those values will be used as the positions of active features
         in the training sparse matrix
         :param row: list, array | a given row of self.data
+        :param names: list | names of the columns of row, those of self.data
+                             if None
         :return: list | list of hash-values/positions
         """
-        if self.hash is None:
-            # Use python built-in hash function
-            hashed_values = list(
-                map(lambda x: hash(str(x)) % self.size, list(row)))
-        else:
-            hashed_values = list(
-                map(lambda x: self.hash(str(x)) % self.size, list(row)))
-        return hashed_values
+        return self.sparsify(row, names)[0]
 
-    def sparsify(self, row):
+    def sparsify(self, row, names=None):
         """
         "Sparsify" a given row of data
         :param row: list, array | a given row of self.data
+        :param names: list | names of the columns of row, those of self.data
+                             if None
         :return: 2-tuple | tuple containing (positions_active_vales, active_values)
         """
+        if names is None:
+            names = self.data.columns if self.data is not None else [""] * len(row)
+        sparse_values = [self.hash_column([x], name) for x, name in zip(row, names)]
+        return ([int(p[0]) for p, _ in sparse_values],
+                [float(v[0]) for _, v in sparse_values])
+
+    def positions(self, values, name="", size=None):
+        """
+        Positions of the active features of the values of a column
+        :param values: pd.Series, array | a given column of self.data
+        :param name: str | name of the column
+        :param size: int | size of the sparse vectors, self.size if None
+        :return: np.array | position of each value
+        """
+        size = self.size if size is None else size
+        if self.hash is None:
+            hashed = murmurhash3_32(to_keys(values), self.column_seed(name))
+            return hashed.astype(np.int64) % size
+        # Each distinct value is hashed once
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        return np.array([self.hash(str(x)) % size for x in uniques],
+                        dtype=np.int64)[codes]
+
+    def hash_column(self, values, name=""):
+        """
+        Hashes a whole column of data
+        :param values: pd.Series, array | a given column of self.data
+        :param name: str | name of the column
+        :return: 2-tuple | positions of the active features and their values
+                           (1.0, or +1/-1 if self.signed)
+        """
         # TODO: change if you want to take into account continuous values
-        return (self.hash_row(row), [1.0] * len(row))
+        positions = self.positions(values, name)
+        if self.signed:
+            hashed = murmurhash3_32(to_keys(values), self.column_seed(name))
+            active_values = np.where(hashed >> np.uint32(31), -1., 1.)
+        else:
+            active_values = np.ones(len(positions))
+        return positions, active_values
+
+    #########################
+    #      Diagnostics      #
+    #########################
+
+    @staticmethod
+    def distinct_values(data):
+        """
+        Distinct values of each column (values with the same hash key, ex:
+        None and NaN, are the same value)
+        :param data: pd.DataFrame | data to hash
+        :return: dict | {column: np.array of distinct values}
+        """
+        distinct = dict()
+        for col in data.columns:
+            values = np.asarray(data[col].values)
+            first = np.unique(to_keys(values), return_index=True)[1]
+            distinct[col] = values[first]
+        return distinct
+
+    def collisions(self, data, size=None, distinct=None):
+        """
+        Measures the collisions of the hash-values of data
+        The collision rate is the share of the distinct values that don't
+        get a position of their own: 1 - n_buckets / n_values
+        :param data: pd.DataFrame | data to hash
+        :param size: int | size of the sparse vectors, self.size if None
+        :param distinct: dict | output of distinct_values(data), to reuse it
+        :return: pd.DataFrame | number of distinct values, of occupied
+                                positions and collision rate of each column,
+                                and of all the columns together ("ALL" row)
+        """
+        size = self.size if size is None else size
+        distinct = self.distinct_values(data) if distinct is None else distinct
+
+        stats, all_positions = [], []
+        for col, values in distinct.items():
+            positions = self.positions(values, col, size)
+            all_positions.append(positions)
+            stats.append((col, len(values), len(np.unique(positions))))
+        all_positions = np.concatenate(all_positions) if all_positions else \
+            np.empty(0, dtype=np.int64)
+        stats.append(("ALL", len(all_positions), len(np.unique(all_positions))))
+
+        stats = pd.DataFrame(stats, columns=["column", "n_values", "n_buckets"])
+        stats["collision_rate"] = 1. - stats.n_buckets / stats.n_values.clip(lower=1)
+        return stats.set_index("column")
+
+    def recommend_size(self, data, max_collision_rate=0.01, max_size=2 ** 31 - 1):
+        """
+        Smallest size of the sparse vectors with a collision rate (of all the
+        columns together) lower than max_collision_rate
+        Found by binary search: the collision rate only decreases with the
+        size on average, a slightly smaller size may also be suitable
+        :param data: pd.DataFrame | data to hash
+        :param max_collision_rate: float | target collision rate
+        :param max_size: int | largest size considered
+        :return: int | recommended size
+        """
+        distinct = self.distinct_values(data)
+
+        def _is_suitable(size):
+            rate = self.collisions(data, size, distinct).collision_rate["ALL"]
+            return rate <= max_collision_rate
+
+        # Find a suitable size, then search between the last two sizes
+        low, high = 0, max(sum(len(v) for v in distinct.values()), 1)
+        while high < max_size and not _is_suitable(high):
+            low, high = high, min(2 * high, max_size)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if _is_suitable(middle):
+                high = middle
+            else:
+                low = middle
+        return high
 
     def transform(self, data, cores=1):
         """
         Creates a sparse matrix from data
         data MUST NOT contain the labels
+        The matrix is built in one shot from its indptr/indices/data arrays:
+        each row has one active feature per column (values of colliding
+        features are summed)
         :param data: pd.DataFrame | dataframe to sparsify
+        :param cores: int | number of processes hashing the columns
         :return: scipy.csr_matrix | sparse matrix of shape (data.shape[0], self.size)
         """
-        curr_csr_matrix = csr_matrix((data.shape[0], self.size))
-
-        if cores > 1:
-            # Multithreaded computing
-            def _get_crs_mat(row):
-                i, row = row[0], row[1:]
-                sparse_row = self.sparsify(row)
-                row_csr_matrix = csr_matrix(
-                    (sparse_row[1], ([i] * len(row), sparse_row[0])),
-                    shape=curr_csr_matrix.shape)
-                return row_csr_matrix
-
-            matrix_list = Pool(cores).map(lambda row: _get_crs_mat(row),
-                                          data.itertuples())
-            curr_csr_matrix = sum(matrix_list)
+        n_rows, n_cols = data.shape
+        columns = [(data[col].values, col) for col in data.columns]
 
+        if cores > 1 and n_cols > 1:
+            # One column per task, without sending self (and self.data)
+            params = (self.size, self.hash, self.seed, self.signed)
+            with Pool(cores) as p:
+                hashed = p.map(_hash_column,
+                               [column + params for column in columns])
         else:
-            for row in data.itertuples():
-                i, row = row[0], row[1:]
-                sparse_row = self.sparsify(row)
-                curr_csr_matrix = curr_csr_matrix + csr_matrix(
-                    (sparse_row[1], ([i] * len(row), sparse_row[0])),
-                    shape=curr_csr_matrix.shape)
+            hashed = [self.hash_column(*column) for column in columns]
 
-        return curr_csr_matrix
+        # Row i holds the positions indices[i * n_cols:(i + 1) * n_cols]
+        if hashed:
+            indices = np.stack([h[0] for h in hashed], axis=1).ravel()
+            values = np.stack([h[1] for h in hashed], axis=1).ravel()
+        else:
+            indices, values = np.empty(0, dtype=np.int64), np.empty(0)
+        indptr = np.arange(n_rows + 1, dtype=np.int64) * n_cols
+        sparse_matrix = csr_matrix((values, indices, indptr),
+                                   shape=(n_rows, self.size))
+        sparse_matrix.sum_duplicates()
+        if self.signed:
+            sparse_matrix.eliminate_zeros()
+        return sparse_matrix
 
     def fit_transform(self, data, cores=1):
         self.fit(data)
         return self.transform(self.data, cores=cores)
 
+    def transform_to_disk(self, data, path, label=None, chunksize=1000000,
+                          cores=1, **read_csv_kwargs):
+        """
+        Creates a sparse matrix from data too big to fit in memory
+        data is read by chunks, each chunk is hashed and saved as a shard:
+        its indptr, indices and data arrays (and labels) as .npy files, that
+        iter_shards memory-maps. Peak memory only depends on chunksize
+        :param data: str, pd.DataFrame, iterable | path of a csv file, a
+                                                  dataframe or an iterable of
+                                                  dataframes
+        :param path: str | directory of the shards (created if needed)
+        :param label: str | column of the labels, saved apart (optional)
+        :param chunksize: int | number of rows per shard (csv file or dataframe)
+        :param cores: int | number of processes hashing the columns
+        :param read_csv_kwargs: other arguments of pd.read_csv (ex: usecols)
+        :return: int | number of rows hashed
+        """
+        if self.size is None:
+            raise IOError("size must be set to hash data by chunks, "
+                          "see recommend_size")
+        if isinstance(data, str):
+            data = pd.read_csv(data, chunksize=chunksize, **read_csv_kwargs)
+        elif isinstance(data, pd.DataFrame):
+            data = [data.iloc[start:start + chunksize]
+                    for start in range(0, len(data), chunksize)]
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        shards, columns = [], None
+        for i, chunk in enumerate(data):
+            if label is not None:
+                np.save(os.path.join(path, "%05d_label.npy" % i),
+                        chunk[label].values)
+                chunk = chunk.drop(columns=[label])
+            # The columns of the first chunk are the columns of the matrix
+            if columns is None:
+                columns = list(chunk.columns)
+            elif list(chunk.columns) != columns:
+                raise IOError("Chunk %d doesn't have the columns %s" % (i, columns))
+
+            sparse_matrix = self.transform(chunk, cores=cores)
+            for name in ["indptr", "indices", "data"]:
+                np.save(os.path.join(path, "%05d_%s.npy" % (i, name)),
+                        getattr(sparse_matrix, name))
+            shards.append(sparse_matrix.shape[0])
+
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"size": self.size, "columns": columns, "label": label,
+                       "shards": shards}, f)
+        return sum(shards)
+
+
+def iter_shards(path, batch_size=None):
+    """
+    Iterates over a sparse matrix written by Hasher.transform_to_disk
+    The shards are memory-mapped: only the rows used are read from the disk
+    :param path: str | directory of the shards
+    :param batch_size: int | number of rows per block, one block per shard
+                             if None
+    :return: generator | blocks of rows: scipy.csr_matrix, or
+                         (scipy.csr_matrix, np.array of labels) if the labels
+                         were saved
+    """
+    with open(os.path.join(path, "index.json"), "r") as f:
+        index = json.load(f)
+
+    for i, n_rows in enumerate(index["shards"]):
+        indptr, indices, values = [
+            np.load(os.path.join(path, "%05d_%s.npy" % (i, name)), mmap_mode="r")
+            for name in ["indptr", "indices", "data"]]
+        if index["label"] is not None:
+            labels = np.load(os.path.join(path, "%05d_label.npy" % i),
+                             mmap_mode="r")
+
+        step = n_rows if batch_size is None else batch_size
+        for start in range(0, n_rows, max(step, 1)):
+            end = min(start + step, n_rows)
+            # Views of the shard, only indptr is rebased
+            first, last = indptr[start], indptr[end]
+            block = csr_matrix((values[first:last], indices[first:last],
+                                indptr[start:end + 1] - first),
+                               shape=(end - start, index["size"]), copy=False)
+            if index["label"] is not None:
+                yield block, labels[start:end]
+            else:
+                yield block
+
 
 if __name__ ==  "__main__":
     """
@@ -101,8 +438,9 @@ if __name__ ==  "__main__":
 
     # Process your data
     """
-     /!\ Important : In order to make sure to have one hash-value per value for each feature
-                     you should transform your data to concatenate "feature_name" and "value"
+     Values are hashed with a seed depending on their column: the same value
+     in two features gives two different hash-values, no need to concatenate
+     "feature_name" and "value"
     """
      # transforms
     data_processed = data # to change here
@@ -110,7 +448,20 @@ if __name__ ==  "__main__":
     # Instanciate Hasher
     hash = Hasher(size=10000) # carefully choose "size" parameter no to have collisions when hashing
 
+    # Check the collisions of this size, and the smallest size with 1% of collisions
+    print(hash.collisions(data_processed))
+    print(hash.recommend_size(data_processed, max_collision_rate=0.01))
+
     # Fit to Data
     data_sparse = hash.fit_transform(data_processed)
 
+    # The hash-values don't depend on the process: the test set can be
+    # hashed later, by another script
     # Now use data_sparse as an entry to your learning model
+
+    # Data too big to fit in memory is hashed by chunks to the disk, then read
+    # by blocks of rows (ex: for SGDClassifier.partial_fit)
+    hash.transform_to_disk("./data/train.csv", "./data/train_hashed",
+                           label="is_listened", chunksize=1000000)
+    for X_block, y_block in iter_shards("./data/train_hashed", batch_size=100000):
+        pass
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from .Hasher import to_keys, mix64
 
 class Vectorizer():
     """
@@ -14,6 +15,7 @@ class Vectorizer():
         """
         self.transforms = transforms
         self.data = None
+        self.crosses = dict()
 
     def fit(self, data):
         """
@@ -40,17 +42,35 @@ class Vectorizer():
 
     def cross_features(self, feature_1, feature_2, symbol='&'):
         """
-
+        Adds the cross of two features to self.data, as an int64 column
+        named feature_1 + symbol + feature_2
+        The values of the two features are combined by a 64-bit mix of their
+        keys: the same pair of values gives the same integer in any dataset,
+        use labels to read them
         :param feature_1: str | name of the first feature in the cross-feature
         :param feature_2: str | name of the second feature in the cross-feature
         :param symbol: str | symbol to join the values of the two features
         """
-        feat1_values, feat2_values = self.data[feature_1], self.data[feature_2]
-        zipped = list(zip(feat1_values, "&" * self.data.shape[0], feat2_values))
-        new_col = list(
-            map(lambda t: str(t[0]) + t[1] + str(t[2]), list(zipped)))
+        name = feature_1 + symbol + feature_2
+        crossed = mix64(to_keys(self.data[feature_1].values),
+                        to_keys(self.data[feature_2].values))
         # Update data
-        self.data[feature_1 + symbol + feature_2] = new_col
+        self.data[name] = crossed.view(np.int64)
+        self.crosses[name] = (feature_1, feature_2, symbol)
+
+    def labels(self, name):
+        """
+        Readable labels of a cross feature, built on demand from self.data
+        :param name: str | name of the cross feature
+        :return: pd.Series | {value of the cross: label}, labels having the
+                             format value1 + symbol + value2
+        """
+        feature_1, feature_2, symbol = self.crosses[name]
+        values, first = np.unique(self.data[name].values, return_index=True)
+        labels = [str(a) + symbol + str(b) for a, b in
+                  zip(self.data[feature_1].values[first],
+                      self.data[feature_2].values[first])]
+        return pd.Series(labels, index=values)
 
     def transform(self, transforms):
         """
@@ -93,4 +113,7 @@ if __name__ == "__main__":
     vect.fit_transform(data=data, transforms=transforms)
 
     # Check that 3 new columns have been added
-    data.columns
\ No newline at end of file
+    data.columns
+
+    # Labels of the values of a cross feature, ex: female&123
+    vect.labels('user_gender&artist_id')
\ No newline at end of file
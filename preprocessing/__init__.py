@@ -1,2 +1,2 @@
-__all__ = ['preprocess_media_ids', 'parse_ts', 'categorise_media_duration',
-           'full_preprocessing']
\ No newline at end of file
+__all__ = ['MediaIdCanonicalizer', 'preprocess_media_ids', 'decompose_ts', 'parse_ts', 'categorise_media_duration',
+           'full_preprocessing', 'stream_preprocessing', 'load_dataset']
\ No newline at end of file
@@ -1,8 +1,84 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
+import numpy as np
 import json
+import os
+import time
 import datetime
 
+# Path of the duplicate media_ids, relative to the package
+UNIQUE_MEDIA_ID_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'unique_media_id.json')
+
+class MediaIdCanonicalizer():
+    """ Map duplicate media_ids to their original media_id
+    
+    The mapping is loaded once, on first use, and compiled into sorted NumPy
+    arrays of duplicates and originals: a whole column is canonicalized with
+    one np.searchsorted and one np.take. Works on Pandas series as well as
+    on plain arrays.
+    """
+
+    _default = None
+
+    def __init__(self, path=UNIQUE_MEDIA_ID_PATH):
+        """
+        Parameters
+        ----------
+        path: Path of a json file {description: [original, duplicates...]}
+        """
+        self.path = path
+        self.duplicates = None
+        self.originals = None
+
+    @classmethod
+    def default(cls):
+        """ Shared instance using the mapping shipped with the package
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return(cls._default)
+
+    def compile(self):
+        """ Load the mapping and compile it into sorted arrays
+        """
+        with open(self.path) as f:
+            unique_media_list = list(json.load(f).values())
+
+        duplicates = np.array([duplicate for elt in unique_media_list
+                               for duplicate in elt[1:]], dtype='int64')
+        originals = np.array([elt[0] for elt in unique_media_list
+                              for duplicate in elt[1:]], dtype='int64')
+        order = np.argsort(duplicates)
+        self.duplicates, self.originals = duplicates[order], originals[order]
+
+    def transform(self, media_ids):
+        """ Canonicalize media_ids
+        
+        Parameters
+        ----------
+        media_ids: Pandas series or array of media_ids
+        
+        Output
+        ------
+        canonical_ids: Same type, dtype (and index) as media_ids
+        """
+        if self.duplicates is None:
+            self.compile()
+
+        values = np.asarray(media_ids)
+        if len(self.duplicates) == 0:
+            return(media_ids.copy())
+        pos = np.minimum(np.searchsorted(self.duplicates, values),
+                         len(self.duplicates) - 1)
+        canonical = np.where(self.duplicates[pos] == values,
+                             self.originals.take(pos), values).astype(values.dtype)
+
+        if isinstance(media_ids, pd.Series):
+            return(pd.Series(canonical, index=media_ids.index,
+                             name=media_ids.name))
+        return(canonical)
+
 def preprocess_media_ids(df):
     """ Clean the duplicate media_ids
     
@@ -14,25 +90,10 @@ def preprocess_media_ids(df):
     df: Pandas dataframe containing a column media_id
     """
 
-    with open('./preprocessing/unique_media_id.json') as f:
-        unique_media_list = json.load(f).values()
-    
-    # Dictionary with key=duplicate media_ids, value=original media_id
-    unique_media_dict = dict()
-    for elt in unique_media_list:
-        for duplicate in elt[1:]:
-            unique_media_dict[duplicate] = elt[0]
-            
-    # Duplicate elements without the original media_ids
-    unique_media_unravel = []
-    for elt in unique_media_list:
-        unique_media_unravel.extend(elt[1:])
-
-    mask_duplicates = df['media_id'].isin(unique_media_unravel)
-    df.loc[mask_duplicates, 'media_id'] = df.loc[mask_duplicates, 'media_id'].map(unique_media_dict)
+    df['media_id'] = MediaIdCanonicalizer.default().transform(df['media_id'])
 
 def convert_ts(ts):
-    """ Convert a timestamp to a date %Y-%m-%d %H:%M:%S
+    """ Convert a timestamp to a date %Y-%m-%d %H:%M:%S (UTC)
     
     Parameters
     ----------
@@ -43,25 +104,62 @@ def convert_ts(ts):
     formatted_date: datetime %Y-%m-%d %H:%M:%S
     """
     
-    formatted_date = datetime.datetime.fromtimestamp(
+    formatted_date = datetime.datetime.utcfromtimestamp(
         ts).strftime('%Y-%m-%d %H:%M:%S')
     return(formatted_date)
 
-def parse_ts(df):
-    """ Create year/month/day/hour columns from ts_listen
+def decompose_ts(ts):
+    """ Split timestamps into UTC year/month/day/hour/weekday
+    
+    Timestamps are converted once with integer arithmetic on datetime64,
+    without building any datetime object or string
+    
+    Parameters
+    ----------
+    ts: Pandas series or array of timestamps (seconds)
+    
+    Output
+    ------
+    parts: Pandas dataframe with the int16 column year and the int8 columns
+           month, day, hour and weekday (Monday is 0), indexed as ts
+    """
+    
+    ts_values = np.asarray(ts, dtype='int64')
+    seconds = ts_values.astype('datetime64[s]')
+    days = seconds.astype('datetime64[D]')
+    months = seconds.astype('datetime64[M]')
+    
+    parts = pd.DataFrame({
+        'year': (months.astype('int64') // 12 + 1970).astype('int16'),
+        'month': (months.astype('int64') % 12 + 1).astype('int8'),
+        'day': ((days - months.astype('datetime64[D]')).astype('int64')
+                + 1).astype('int8'),
+        'hour': (ts_values // 3600 % 24).astype('int8'),
+        # 1970-01-01 was a Thursday
+        'weekday': ((days.astype('int64') + 3) % 7).astype('int8')
+        }, index=ts.index if isinstance(ts, pd.Series) else None)
+    return(parts)
+
+def parse_ts(df, with_fmt=True):
+    """ Create year/month/day/hour/weekday columns from ts_listen (UTC)
     
     Parameters
     ----------
     df: Pandas dataframe containing a column ts_listen
+    with_fmt: Whether to also create the string column ts_listen_fmt
     """
     
-    df['ts_listen_fmt'] = df['ts_listen'].map(convert_ts)
+    if with_fmt:
+        df['ts_listen_fmt'] = pd.to_datetime(
+            df['ts_listen'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    # Parse year/month/day/hour
-    df['year_listen'] = pd.DatetimeIndex(df['ts_listen_fmt']).year
-    df['month_listen'] = pd.DatetimeIndex(df['ts_listen_fmt']).month
-    df['day_listen'] = pd.DatetimeIndex(df['ts_listen_fmt']).day
-    df['hour_listen'] = pd.DatetimeIndex(df['ts_listen_fmt']).hour
+    # Parse year/month/day/hour/weekday
+    parts = decompose_ts(df['ts_listen'])
+    df['year_listen'] = parts['year']
+    df['month_listen'] = parts['month']
+    df['day_listen'] = parts['day']
+    df['hour_listen'] = parts['hour']
+    df['weekday_listen'] = parts['weekday']
 
 
 def categorise_media_duration(df):
@@ -92,3 +190,128 @@ def full_preprocessing(df):
     preprocess_media_ids(df)
     parse_ts(df)
     categorise_media_duration(df)
+
+def _check_chunk_dtypes(chunk, dtypes, i):
+    """ Check that a chunk can be written with the dtypes of the dataset
+    
+    Parameters
+    ----------
+    chunk: Pandas dataframe, preprocessed chunk
+    dtypes: Dict {column: np.dtype}, the dtypes of the dataset
+    i: Number of the chunk, for the error messages
+    """
+    missing = [col for col in dtypes if col not in chunk.columns]
+    extra = [col for col in chunk.columns if col not in dtypes]
+    if missing or extra:
+        raise IOError("Chunk %d does not have the columns of the first chunk "
+                      "(missing: %s, extra: %s)" % (i, missing, extra))
+    for col, dtype in dtypes.items():
+        values = chunk[col]
+        if not np.can_cast(values.dtype, dtype, 'same_kind') or \
+                (dtype.kind in 'biu' and values.isnull().any()):
+            raise IOError("Column %s of chunk %d (%s) can't be stored as %s, "
+                          "the dtype of the first chunk: set the dtype of the "
+                          "column with dtype= in read_csv_kwargs (ex: "
+                          "dtype={'%s': 'float64'})"
+                          % (col, i, values.dtype, dtype, col))
+
+def stream_preprocessing(data, output_dir, chunksize=1000000, verbose=True,
+                         **read_csv_kwargs):
+    """ Full preprocessing of a dataset too big to fit in memory
+    
+    The input is read by chunks of chunksize rows, each chunk is preprocessed
+    (media ids, time parsing, media duration categories) and appended to a
+    columnar dataset on disk: one raw binary file per column plus a
+    meta.json file with the dtypes and the number of rows. Peak memory only
+    depends on chunksize.
+    
+    Parameters
+    ----------
+    data: Path of a csv file, or iterable of Pandas dataframes
+    output_dir: Directory of the dataset (created if needed)
+    chunksize: Number of rows per chunk when reading a csv file
+    verbose: Whether to print the progress and throughput after each chunk
+    read_csv_kwargs: Other arguments of pd.read_csv (ex: dtype to fix the
+                     dtypes of the columns)
+    
+    The dtypes of the first chunk are the dtypes of the dataset: an IOError
+    is raised if a later chunk has other columns, or values that these
+    dtypes can't hold (ex: a missing value in a column of integers). Set the
+    dtypes with dtype= in read_csv_kwargs in that case.
+    
+    Output
+    ------
+    nrows: Number of rows written
+    """
+    if isinstance(data, str):
+        data = pd.read_csv(data, chunksize=chunksize, **read_csv_kwargs)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    dtypes = None
+    files = dict()
+    nrows = 0
+    start = time.time()
+    try:
+        for i, chunk in enumerate(data):
+            preprocess_media_ids(chunk)
+            parse_ts(chunk, with_fmt=False)
+            categorise_media_duration(chunk)
+
+            # The dtypes of the first chunk are the dtypes of the dataset
+            if dtypes is None:
+                dtypes = {col: chunk[col].dtype for col in chunk.columns}
+                for col, dtype in dtypes.items():
+                    if dtype.kind not in 'biuf':
+                        raise IOError("Column %s is not numeric" % col)
+                    files[col] = open(os.path.join(output_dir, col + '.bin'),
+                                      'wb')
+            else:
+                _check_chunk_dtypes(chunk, dtypes, i + 1)
+            for col, dtype in dtypes.items():
+                files[col].write(np.ascontiguousarray(
+                    chunk[col].values.astype(dtype, copy=False)).tobytes())
+            nrows += len(chunk)
+
+            if verbose:
+                elapsed = time.time() - start
+                print("chunk %d: %d rows processed (%.0f rows/s)"
+                      % (i + 1, nrows, nrows / max(elapsed, 1e-9)))
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'nrows': nrows,
+                   'columns': [[col, dtype.str] for col, dtype
+                               in (dtypes or dict()).items()]}, f)
+    return(nrows)
+
+def load_dataset(path, columns=None):
+    """ Load a dataset written by stream_preprocessing
+    
+    The columns are memory-mapped: only what is used is read from the disk
+    
+    Parameters
+    ----------
+    path: Directory of the dataset
+    columns: List of the columns to load, all of them if None
+    
+    Output
+    ------
+    dataset: dict {column: read-only np.memmap}
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    dataset = dict()
+    for col, dtype in meta['columns']:
+        if columns is not None and col not in columns:
+            continue
+        if meta['nrows'] == 0:
+            dataset[col] = np.empty(0, dtype=dtype)
+        else:
+            dataset[col] = np.memmap(os.path.join(path, col + '.bin'),
+                                     dtype=dtype, mode='r',
+                                     shape=(meta['nrows'],))
+    return(dataset)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from features.History import History
+
+
+def _events(n=50000, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({"user_id": rng.randint(0, 500, n),
+                         "ts_listen": rng.randint(1477000000, 1480000000, n),
+                         "media_id": rng.randint(0, 3000, n),
+                         "artist_id": rng.randint(0, 300, n),
+                         "is_listened": rng.randint(0, 2, n)})
+
+
+def test_dump_to_the_loaded_path(tmp_path):
+    path = str(tmp_path / "history")
+    hist = History()
+    hist.fit(_events())
+    hist.dump(path)
+
+    # Daily refresh: the columns of the loaded history are memory-mapped from
+    # the files being rewritten
+    loaded = History(path=path)
+    loaded.append(_events(0))
+    loaded.dump(path)
+    reloaded = History(path=path)
+
+    np.testing.assert_array_equal(reloaded.user_ids, hist.user_ids)
+    np.testing.assert_array_equal(reloaded.user_ptr, hist.user_ptr)
+    for col, values in hist.columns.items():
+        np.testing.assert_array_equal(reloaded.columns[col], values)
+
+
+def test_fit_multiproc_is_fit():
+    data = _events()
+    data.loc[::3, "ts_listen"] = 1478000000
+    hist = History()
+    hist.fit(data)
+    for cores in [1, 2]:
+        multi = History()
+        multi.fit_multiproc(data, cores=cores)
+        np.testing.assert_array_equal(multi.user_ids, hist.user_ids)
+        np.testing.assert_array_equal(multi.user_ptr, hist.user_ptr)
+        for col, values in hist.columns.items():
+            np.testing.assert_array_equal(multi.columns[col], values)
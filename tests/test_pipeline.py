@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features.pipeline import FeaturePipeline, Feature
+
+
+def _registry():
+    return {"double": Feature("double", lambda x: 2 * x, ["x"]),
+            "shifted": Feature("shifted", lambda double, offset: double + offset,
+                               ["double"], requires=["offset"])}
+
+
+def test_all_features_need_their_resources():
+    data = pd.DataFrame({"x": np.arange(5)})
+    features = FeaturePipeline(registry=_registry()).transform(data)
+    assert list(features.columns) == ["double"]
+
+    features = FeaturePipeline(registry=_registry(), offset=1).transform(data)
+    np.testing.assert_array_equal(features["shifted"], 2 * np.arange(5) + 1)
+
+
+def test_missing_resource():
+    data = pd.DataFrame({"x": np.arange(5)})
+    with pytest.raises(IOError, match="offset"):
+        FeaturePipeline(registry=_registry()).transform(data, ["shifted"])
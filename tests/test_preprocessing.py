@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing.preprocessing import stream_preprocessing, load_dataset
+
+
+def _csv(path, n=10000):
+    rng = np.random.RandomState(0)
+    data = pd.DataFrame({"media_id": rng.randint(0, 10 ** 6, n),
+                         "artist_id": rng.randint(0, 1000, n),
+                         "ts_listen": rng.randint(1477000000, 1480000000, n),
+                         "media_duration": rng.randint(30, 600, n)})
+    # Integers, with an empty value in the second chunk
+    data["artist_id"] = data["artist_id"].astype("Int64")
+    data.loc[5000, "artist_id"] = None
+    data.to_csv(path, index=False)
+    return data
+
+
+def test_missing_value_after_the_first_chunk(tmp_path):
+    path = str(tmp_path / "train.csv")
+    data = _csv(path)
+
+    with pytest.raises(IOError, match="dtype="):
+        stream_preprocessing(path, str(tmp_path / "out"), chunksize=3000,
+                             verbose=False)
+
+    nrows = stream_preprocessing(path, str(tmp_path / "out"), chunksize=3000,
+                                 verbose=False, dtype={"artist_id": "float64"})
+    dataset = load_dataset(str(tmp_path / "out"), columns=["artist_id"])
+    assert nrows == len(data)
+    np.testing.assert_array_equal(dataset["artist_id"], data["artist_id"].astype(float).values)
+
+
+def test_chunks_with_other_columns(tmp_path):
+    chunk = pd.DataFrame({"media_id": [1, 2], "ts_listen": [1477000000] * 2,
+                          "media_duration": [100, 200]})
+    chunks = [chunk, chunk.assign(artist_id=1)]
+    with pytest.raises(IOError, match="extra"):
+        stream_preprocessing(chunks, str(tmp_path / "out"), verbose=False)
@@ -3,98 +3,87 @@ import pandas as pd
 import numpy as np
 
 
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
-def train_test_split(data, n_splits=2):
+def train_test_split_indices(data, n_splits=2):
     """
-    This function creates a set for cross-validation
+    Positions of the rows of the train/test sets created by train_test_split
+    The data is sorted once by (user_id, ts_listen): the listens of each user
+    are cut in n_splits chunks of ceil(n / n_splits) listens, the train set i
+    is the chunk i of every user and its test set the next listen of each user
+    (the last listen of the chunk for the last chunk). Users without enough
+    listens to fill the n_splits chunks are ignored
     :param data: pd.DataFrame
-    :return: tuple(pd.DataFrame, pd.DataFrame, list)
+    :param n_splits: int | number of train/test sets
+    :return: list | n_splits tuples(np.array, np.array, np.array): positions
+             (for data.iloc) of the train and test rows, and timeframes, an
+             array of shape (max(user_id) + 1, 2) giving the first and last
+             ts_listen of the train data of each user ((0, 0) if ignored)
     """
 
     if any(col not in data.columns for col in ["user_id", "ts_listen"]):
         raise IOError("The DF must contain fields user_id and ts_listen")
 
-    data_by_user = data.groupby("user_id")
-    user_ids = np.unique(data.user_id.values)
+    user_ids = data.user_id.values
+    timestamps = data.ts_listen.values
+    order = np.lexsort((timestamps, user_ids))
+    sorted_ts = timestamps[order]
+
+    users, user_start, user_count = np.unique(user_ids[order], return_index=True,
+                                              return_counts=True)
+    # eache user has a different train_length
+    n_train_samples = -(-user_count // n_splits)
+    n_chunks = -(-user_count // n_train_samples)
+    last_chunk_length = user_count - (n_chunks - 1) * n_train_samples
+    # users with not enough samples are ignored
+    valid = (n_chunks == n_splits) & (last_chunk_length > 1)
+
+    # Position of each row among the listens of its user, and its chunk
+    row_user = np.repeat(np.arange(len(users)), user_count)
+    position = np.arange(len(order)) - user_start[row_user]
+    chunk = position // n_train_samples[row_user]
+    is_last = position == user_count[row_user] - 1
+
+    timeframes_shape = (users.max() + 1 if len(users) else 0, 2)
+    sets = []
+    for i in range(n_splits):
+        train_rows = valid[row_user] & (chunk == i) & ~is_last
 
-    idx_train = [[] for i in range(n_splits)]
-    idx_test = [[] for i in range(n_splits)]
+        # last chunk should be shifted to the left
+        if i < n_splits - 1:
+            test_position = (i + 1) * n_train_samples[valid]
+        else:
+            test_position = user_count[valid] - 1
+        test_rows = user_start[valid] + test_position
 
-    timestamps = data.ts_listen.values
-    timeframes = [[(0,0)] * np.max(user_ids) for i in range(n_splits)]
-
-    for user_id in user_ids:
-        df_user = data_by_user.get_group(user_id)
-
-        # sort ts_listen values
-        user_values = df_user.ts_listen.values
-        sort_index = np.argsort(user_values)
-
-        idx = df_user.index[sort_index]
-
-        # eache user has a different train_length
-        n_train_samples = int(np.ceil(len(user_values) / n_splits))
-        
-        if n_train_samples == 0:
-            continue
-
-        idx_chunks = chunks(range(len(user_values)), n_train_samples)
-        train_chunks = []
-        test_chunks = []
-        ts_chunks = []
-
-        for chunk in idx_chunks:
-            # last chunk should be shifted to the left
-            if chunk[-1] == len(user_values) - 1 and len(chunk) > 1:
-                ts_chunks.append([idx[chunk[0]], idx[chunk[-2]]])
-                train_chunks.append(idx[chunk[0:-1]])
-                test_chunks.append(idx[chunk[-1]])
-                
-            # not enough samples to create a train and test set
-            elif chunk[-1] == len(user_values) - 1:
-                continue
-            
-            else:
-                ts_chunks.append([idx[chunk[0]], idx[chunk[-1]]])
-                train_chunks.append(idx[chunk])
-                test_chunks.append(idx[chunk[-1] + 1])
-
-  
-        # users with not enough samples are ignored
-        if len(train_chunks) < n_splits:
-            continue
-
-        for i in range(n_splits):
-            timeframes[i][user_id] = (timestamps[ts_chunks[i][0]],
-                                      timestamps[ts_chunks[i][1]])
-
-            idx_train[i].extend(train_chunks[i].tolist())
-            idx_test[i].extend([test_chunks[i]])
+        timeframes = np.zeros(timeframes_shape, dtype='int64')
+        timeframes[users[valid], 0] = sorted_ts[
+            user_start[valid] + i * n_train_samples[valid]]
+        timeframes[users[valid], 1] = sorted_ts[test_rows - 1]
 
-    for i in range(n_splits):
-        idx_train[i] = np.asarray(idx_train[i], dtype='int64')
-        idx_test[i] = np.asarray(idx_test[i], dtype='int64')
+        sets.append((order[train_rows].astype('int64'),
+                     order[test_rows].astype('int64'), timeframes))
+    return sets
+
+
+def train_test_split(data, n_splits=2):
+    """
+    This function creates a set for cross-validation
+    :param data: pd.DataFrame
+    :param n_splits: int | number of train/test sets
+    :return: list | n_splits tuple(pd.DataFrame, pd.DataFrame, np.array), see
+             train_test_split_indices for the timeframes
+    """
 
-    return [(data.ix[idx_train[i]], data.ix[idx_test[i]], timeframes[i]) for i in range(n_splits)]
+    return [(data.iloc[idx_train], data.iloc[idx_test], timeframes)
+            for idx_train, idx_test, timeframes
+            in train_test_split_indices(data, n_splits)]
 
 
 def check_timeframes(timeframes, test):
     """ Tests for the generated sets
     """
-    user_ids = test.user_id.values
-    ts = test.ts_listen.values
-    for i in range(len(user_ids)):
-        user_id = user_ids[i]
-        ts_listen = ts[i]
-        
-        ts_begin, ts_end = timeframes[user_id]
-        assert ts_begin <= ts_end
-        assert ts_end < ts_listen
+    ts_begin, ts_end = np.asarray(timeframes)[test.user_id.values].T
+    assert (ts_begin <= ts_end).all()
+    assert (ts_end < test.ts_listen.values).all()
 
 
 if __name__ == '__main__':
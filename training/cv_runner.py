@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import time
+import resource
+import tracemalloc
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool, shared_memory
+from scipy.sparse import csr_matrix, issparse
+from scipy.stats import rankdata
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+
+from features.History import to_shared_memory
+
+# Dataset and model shared with the workers of cross_validate
+_worker_data = dict()
+
+
+def auc_score(y_true, scores):
+    """ Area under the ROC curve (Mann-Whitney statistic, ties count half)
+
+    Parameters
+    ----------
+    y_true: Array of binary labels
+    scores: Array of scores, higher for the positive class
+
+    Output
+    ------
+    auc: Float, nan if y_true contains only one class
+    """
+    y_true = np.asarray(y_true) == 1
+    n_pos = y_true.sum()
+    n_neg = len(y_true) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return(np.nan)
+    ranks = rankdata(scores)
+    return((ranks[y_true].sum() - n_pos * (n_pos + 1) / 2.) / (n_pos * n_neg))
+
+
+def _attach(desc):
+    """ View of an array shared with to_shared_memory
+    """
+    shm = shared_memory.SharedMemory(name=desc[0])
+    # Keep the block open as long as the worker uses it
+    _worker_data.setdefault('blocks', []).append(shm)
+    return(np.ndarray(desc[1], dtype=desc[2], buffer=shm.buf))
+
+
+def _init_worker(arrays, shape, model, trace_memory, shared=True):
+    """ Sets the dataset and model of a worker
+
+    arrays is a dict {name: array}, or {name: (name, shape, dtype)} of shared
+    arrays if shared
+    """
+    if shared:
+        arrays = {name: _attach(desc) for name, desc in arrays.items()}
+    if 'indptr' in arrays:
+        _worker_data['X'] = csr_matrix((arrays['data'], arrays['indices'],
+                                        arrays['indptr']), shape=shape,
+                                       copy=False)
+    else:
+        _worker_data['X'] = arrays['X']
+    for name in ['y', 'train_idx', 'test_idx']:
+        _worker_data[name] = arrays[name]
+    _worker_data['model'] = model
+    _worker_data['trace_memory'] = trace_memory
+
+
+def _predict_scores(model, X):
+    """ Scores of the positive class
+    """
+    if hasattr(model, 'predict_proba'):
+        return(model.predict_proba(X)[:, 1])
+    if hasattr(model, 'decision_function'):
+        return(model.decision_function(X))
+    return(model.predict(X))
+
+
+def _run_job(args):
+    """ Fits and evaluates a model on a fold (used for multiprocessing)
+    """
+    fold, params_id, params, train_range, test_range = args
+    if _worker_data['trace_memory']:
+        tracemalloc.start()
+
+    # Only the rows of the fold are copied from the shared dataset
+    train_idx = _worker_data['train_idx'][train_range[0]:train_range[1]]
+    test_idx = _worker_data['test_idx'][test_range[0]:test_range[1]]
+    X, y = _worker_data['X'], _worker_data['y']
+
+    start = time.time()
+    model = clone(_worker_data['model']).set_params(**params)
+    model.fit(X[train_idx], y[train_idx])
+    fit_time = time.time() - start
+
+    start = time.time()
+    scores = _predict_scores(model, X[test_idx])
+    predict_time = time.time() - start
+
+    peak_memory = np.nan
+    if _worker_data['trace_memory']:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2. ** 20
+        tracemalloc.stop()
+
+    result = {'fold': fold, 'params_id': params_id, 'params': str(params),
+              'n_train': len(train_idx), 'n_test': len(test_idx),
+              'auc': auc_score(y[test_idx], scores),
+              'fit_time': fit_time, 'predict_time': predict_time,
+              'peak_memory': peak_memory,
+              # kB on Linux
+              'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10}
+    result.update(params)
+    return(result)
+
+
+def _fold_indices(fold, n_rows):
+    """ Positions of the rows of a fold given as positions or boolean masks
+    """
+    indices = []
+    for rows in fold[:2]:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            if len(rows) != n_rows:
+                raise IOError("The masks of the folds must have one value per row")
+            rows = np.flatnonzero(rows)
+        indices.append(rows.astype('int64'))
+    return(indices)
+
+
+def cross_validate(model, X, y, folds, param_grid=None, cores=4,
+                   trace_memory=True):
+    """ Evaluates a model on every (fold, parameters) pair, in parallel
+
+    The dataset is placed once in shared memory: each worker views it and
+    only copies the rows of its fold.
+
+    Parameters
+    ----------
+    model: scikit-learn estimator, cloned for every job
+    X: Feature matrix, numpy array or scipy sparse matrix (ex: a Hasher output)
+    y: Array of binary labels
+    folds: List of folds, each fold starting with the train and test rows, as
+           positions or boolean masks. Ex: train_test_split_indices(data, 3)
+           or zip(*train_split_masks(data, 5))
+    param_grid: Parameters to try, dict {name: list of values} or list of such
+                dicts (see sklearn ParameterGrid), the model parameters if None
+    cores: Number of processes, the jobs are run in this process if 1
+    trace_memory: Whether to measure the peak memory allocated by each job
+                  with tracemalloc (slows down the jobs a little)
+
+    Output
+    ------
+    results: Pandas dataframe, one row per job: fold, parameters, n_train,
+             n_test, auc, fit_time and predict_time (seconds), peak_memory
+             (MB allocated by the job) and max_rss (peak MB used by the
+             process so far)
+    """
+    y = np.asarray(y)
+    if issparse(X):
+        X = csr_matrix(X)
+        arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr}
+    else:
+        X = np.asarray(X)
+        arrays = {'X': X}
+    if X.shape[0] != len(y):
+        raise IOError("X and y must have the same number of rows")
+    arrays['y'] = y
+
+    # The rows of the folds, concatenated
+    folds = [_fold_indices(fold, len(y)) for fold in folds]
+    arrays['train_idx'] = np.concatenate([f[0] for f in folds]) if folds \
+        else np.empty(0, dtype='int64')
+    arrays['test_idx'] = np.concatenate([f[1] for f in folds]) if folds \
+        else np.empty(0, dtype='int64')
+    train_ptr = np.cumsum([0] + [len(f[0]) for f in folds])
+    test_ptr = np.cumsum([0] + [len(f[1]) for f in folds])
+
+    params_list = list(ParameterGrid(param_grid)) if param_grid is not None \
+        else [{}]
+    jobs = [(k, j, params, (train_ptr[k], train_ptr[k + 1]),
+             (test_ptr[k], test_ptr[k + 1]))
+            for k in range(len(folds)) for j, params in enumerate(params_list)]
+
+    if cores > 1:
+        blocks = []
+        try:
+            descs = dict()
+            for name, values in arrays.items():
+                shm, descs[name] = to_shared_memory(values)
+                blocks.append(shm)
+            with Pool(cores, initializer=_init_worker,
+                      initargs=(descs, X.shape, model, trace_memory)) as p:
+                results = p.map(_run_job, jobs, chunksize=1)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    else:
+        _init_worker(arrays, X.shape, model, trace_memory, shared=False)
+        results = list(map(_run_job, jobs))
+        _worker_data.clear()
+
+    return(pd.DataFrame(results))
+
+
+if __name__ == '__main__':
+    """
+    Here is how to compare hyperparameters on several folds
+    """
+    from sklearn.linear_model import LogisticRegression
+    from hashing_vectorize.Hasher import Hasher
+    from training.cross_validation import train_test_split_indices
+
+    data = pd.read_csv('./data/train.csv')
+    folds = train_test_split_indices(data, n_splits=3)
+    y = data.pop('is_listened').values
+    X = Hasher(size=2 ** 20).transform(data)
+
+    results = cross_validate(LogisticRegression(solver='liblinear'), X, y, folds,
+                             param_grid={'C': [0.01, 0.1, 1.]}, cores=4)
+    print(results.groupby('C')[['auc', 'fit_time', 'peak_memory']].mean())
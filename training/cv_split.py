@@ -1,5 +1,70 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
+import numpy as np
+
+def flow_rank(train):
+    """ Rank of the Flow events (listen_type == 1) of each user, from the end
+
+    Parameters
+    ----------
+    train: Pandas dataframe, training set
+
+    Output
+    ------
+    rank: Array, 0 for the last Flow event of its user, 1 for the one
+          before... and -1 for the other events
+    """
+
+    user_ids = train['user_id'].values
+    flow = train['listen_type'].values == 1
+
+    # Flow events sorted by user, then time (stable: ties keep the data order)
+    order = np.lexsort((train['ts_listen'].values, user_ids))
+    order = order[flow[order]]
+    users, user_start, user_count = np.unique(user_ids[order], return_index=True,
+                                              return_counts=True)
+    row_user = np.repeat(np.arange(len(users)), user_count)
+
+    rank = np.full(len(train), -1, dtype='int64')
+    rank[order] = (user_count[row_user] - 1
+                   - (np.arange(len(order)) - user_start[row_user]))
+    return rank
+
+def train_split_masks(train, nb_folds=1, nb_songs=1):
+    """ Split training data in several folds of train/test, as boolean masks
+
+    The test set of the fold k contains the Flow events of rank k to
+    k + nb_songs - 1 from the end of each user (see flow_rank). They are
+    removed from the train set, and kept in the test set only if the user
+    has other events in the train set.
+
+    Parameters
+    ----------
+    train: Pandas dataframe, training set
+    nb_folds: Number of folds wanted
+    nb_songs: Number of songs for each user in the test sets
+
+    Output
+    ------
+    train_masks: (nb_folds, len(train)) boolean array, rows of the train folds
+    test_masks: (nb_folds, len(train)) boolean array, rows of the test folds
+    """
+
+    rank = flow_rank(train)
+    user_codes = pd.factorize(train['user_id'].values)[0]
+    user_total = np.bincount(user_codes)
+
+    train_masks = np.empty((nb_folds, len(train)), dtype=bool)
+    test_masks = np.empty((nb_folds, len(train)), dtype=bool)
+    for k in range(nb_folds):
+        is_test = (rank >= k) & (rank < k + nb_songs)
+        train_masks[k] = ~is_test
+
+        # Make sure that every user in the test set is in the train set
+        user_test = np.bincount(user_codes[is_test], minlength=len(user_total))
+        test_masks[k] = is_test & (user_total > user_test)[user_codes]
+
+    return train_masks, test_masks
 
 def train_split_2(train, nb_songs):
     """ Split training data in train/test:
@@ -15,22 +80,14 @@ def train_split_2(train, nb_songs):
     test_f: Pandas dataframe, the test fold
     """
 
-    train_sorted = train.sort_values(by='ts_listen')
+    train_masks, test_masks = train_split_masks(train, 1, nb_songs)
+
+    order = np.argsort(train['ts_listen'].values, kind='stable')
+    train_sorted = train.iloc[order]
     train_sorted['index'] = train_sorted.index
-    
-    train_index = set(train_sorted['index'].values)
-    test_index = set()
-    for k in range(nb_songs):
-        current_test_index = train_sorted[train_sorted['listen_type'] == 1].groupby('user_id')['index'].nth(-(k+1)).values
-        
-        # Remove elements in test set from the train set
-        train_index = train_index.difference(set(current_test_index))
-        test_index = test_index.union(set(current_test_index))
-    
-    train_f = train_sorted.loc[train_index]
-    test_f_temp = train_sorted.loc[test_index]
-    # Make sure that every user in the test set are in the train set
-    test_f = test_f_temp[test_f_temp['user_id'].isin(train_f['user_id'].unique())]
+
+    train_f = train_sorted[train_masks[0][order]]
+    test_f = train_sorted[test_masks[0][order]]
 
     return train_f, test_f
 
@@ -44,33 +101,15 @@ def train_split(train, nb_folds=1):
 
     Output
     ------
-    train_folds: list of the train folds indices
-    test_folds: list of the test folds indices
+    train_folds: list of the train folds indices (arrays of index labels)
+    test_folds: list of the test folds indices (arrays of index labels)
     """
 
-    train_sorted = train.sort_values(by='ts_listen')
-    train_sorted['index'] = train_sorted.index
-    
-    train_folds = []
-    test_folds_temp = []
-    test_folds = []
-    
-    for k in range(nb_folds):
-        train_index = set(train_sorted['index'].values)
-        
-        # Each test sets contain 1 song with Flow
-        test_index = train_sorted[train_sorted['listen_type'] == 1].groupby('user_id')['index'].nth(-(k+1)).values
-        
-        # Remove elements in test set from the train set
-        train_index = train_index.difference(set(test_index))
-        train_folds.append(train_index)
-        test_folds_temp.append(train_sorted.loc[test_index])
-    
-    for (k, test_f) in enumerate(test_folds_temp):
-        # Make sure that each user_id in the test set is
-        # the train set
-        train_f = train_sorted.loc[train_folds[k]]
-        new_test_f_index = set(test_f[test_f['user_id'].isin(train_f['user_id'].unique())]['index'].values)
-        test_folds.append(new_test_f_index)
-
-    return train_folds, test_folds
\ No newline at end of file
+    # Each test sets contain 1 song with Flow
+    train_masks, test_masks = train_split_masks(train, nb_folds)
+    index = train.index.values
+
+    train_folds = [index[mask] for mask in train_masks]
+    test_folds = [index[mask] for mask in test_masks]
+
+    return train_folds, test_folds